@@ -0,0 +1,217 @@
+import tarfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from os import makedirs, remove, urandom
+from os.path import join
+from shutil import rmtree
+from tempfile import TemporaryDirectory
+from unittest.mock import Mock, patch
+from uuid import uuid4
+
+import bagit
+import boto3
+from django.db import transaction
+from django.test.utils import setup_databases, teardown_databases
+from moto import mock_s3
+
+from package_bag.helpers import path_size
+from package_bag.models import Bag
+from package_bag.routines import (BagDiscoverer, PackageArchiver,
+                                  PackageDeliverer, PackageMaker,
+                                  RightsAssigner, S3ObjectDownloader,
+                                  S3ObjectFinder)
+from zorya import settings
+
+ROUTINES = [
+    S3ObjectFinder,
+    S3ObjectDownloader,
+    BagDiscoverer,
+    RightsAssigner,
+    PackageMaker,
+    PackageArchiver,
+    PackageDeliverer,
+]
+
+BAG_INFO = {
+    "ArchivesSpace-URI": "/repositories/2/archival_objects/12345",
+    "BagIt-Profile-Identifier": "zorya_bagit_profile.json",
+    "Start-Date": "1961-01-01",
+    "End-Date": "1963-12-31",
+    "Origin": "digitization",
+}
+
+
+def make_payload(size, compressibility):
+    """Returns data of which roughly the fraction `compressibility` can be compressed away."""
+    compressible = int(size * compressibility)
+    return (b"zorya " * (compressible // 6 + 1))[:compressible] + urandom(size - compressible)
+
+
+def make_bag(bag_path, files, file_size, compressibility, rights_id="1"):
+    """Creates a bag of synthetic files which conforms to the Zorya BagIt profile.
+
+    Args:
+        bag_path (str): path of the directory to create the bag in.
+        files (int): number of payload files.
+        file_size (int): size of each payload file, in bytes.
+        compressibility (float): fraction of each file which is compressible.
+        rights_id (str): Rights-ID for the bag.
+
+    Returns:
+        bag (bagit.Bag): the bag created.
+    """
+    makedirs(bag_path)
+    for index in range(files):
+        with open(join(bag_path, "file_{:06d}.bin".format(index)), "wb") as f:
+            f.write(make_payload(file_size, compressibility))
+    return bagit.make_bag(bag_path, dict(BAG_INFO, **{"Rights-ID": rights_id}), checksums=["sha256"])
+
+
+@contextmanager
+def throwaway_database():
+    """Points the default database connection at a newly created, empty test database.
+
+    The test database is migrated on entry and destroyed on exit, so routines
+    run against it can never claim, move or delete the files of real bags.
+    """
+    old_config = setup_databases(verbosity=0, interactive=False, aliases={"default"}, serialized_aliases=set())
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+
+@contextmanager
+def sandbox(**overrides):
+    """Sets up an environment in which routines can be run without side effects.
+
+    Files are written to temporary directories and S3 is mocked. Database
+    changes made in the environment are rolled back when it is left. Since
+    routines claim every bag in the database, not just the ones created here,
+    the environment refuses to start unless there are no bags in the database;
+    use `throwaway_database` to run it against an empty one.
+
+    Args:
+        overrides: settings to override while in the environment.
+
+    Yields:
+        root (str): path of a temporary directory.
+        client (botocore.client.S3): a client for the mocked S3 bucket.
+    """
+    if Bag.objects.exists():
+        raise Exception("Routines cannot be run in a sandbox against a database which already contains bags.")
+    with TemporaryDirectory() as root, mock_s3():
+        directories = {name: join(root, name.lower()) for name in ("SRC_DIR", "TMP_DIR", "DEST_DIR")}
+        for directory in directories.values():
+            makedirs(directory)
+        with patch.multiple(settings, **directories, **overrides), transaction.atomic():
+            region_name, access_key, secret_key, bucket = settings.S3
+            client = boto3.client("s3", region_name=region_name, aws_access_key_id=access_key, aws_secret_access_key=secret_key)
+            client.create_bucket(Bucket=bucket)
+            yield root, client
+            transaction.set_rollback(True)
+
+
+def upload_bag(client, root, files, file_size, compressibility, rights_id="1"):
+    """Creates a synthetic bag and uploads it to the bucket as a TAR.GZ.
+
+    Returns:
+        key (str): the key of the uploaded object.
+        payload_size (int): total size of the bag's payload files.
+    """
+    name = uuid4().hex
+    bag_path = join(root, "bags", name)
+    make_bag(bag_path, files, file_size, compressibility, rights_id)
+    payload_size = path_size(join(bag_path, "data"))
+    tar_path = "{}.tar.gz".format(bag_path)
+    with tarfile.open(tar_path, "w:gz") as tf:
+        tf.add(bag_path, arcname=name)
+    key = "{}.tar.gz".format(name)
+    client.upload_file(tar_path, settings.S3[3], key)
+    rmtree(bag_path)
+    remove(tar_path)
+    return key, payload_size
+
+
+class Benchmark(object):
+    """Runs each routine over a set of synthetic bags, measuring throughput and peak memory.
+
+    Bags are uploaded to a mocked S3 bucket alongside other objects which are
+    not bags, then passed through every routine in pipeline order. Requests to
+    the rights and delivery services are answered by a stub after
+    `service_latency` seconds.
+
+    Args:
+        bags (int): number of bags.
+        files (int): number of payload files in each bag.
+        file_size (int): size of each payload file, in bytes.
+        compressibility (float): fraction of each payload file which is compressible.
+        other_objects (int): number of objects in the bucket which are not bags.
+        service_latency (float): seconds taken by each request to the rights
+            and delivery services.
+    """
+
+    def __init__(self, bags=10, files=100, file_size=1024 * 1024, compressibility=0.5, other_objects=1000, service_latency=0.05):
+        self.bags = bags
+        self.files = files
+        self.file_size = file_size
+        self.compressibility = compressibility
+        self.other_objects = other_objects
+        self.service_latency = service_latency
+
+    @property
+    def parameters(self):
+        return {
+            "bags": self.bags,
+            "files": self.files,
+            "file_size": self.file_size,
+            "compressibility": self.compressibility,
+            "other_objects": self.other_objects,
+            "service_latency": self.service_latency}
+
+    def run(self):
+        """Runs the benchmark.
+
+        Returns:
+            results (dict): measurements for each routine, keyed by routine name.
+        """
+        with sandbox() as (root, client), patch("package_bag.routines.post", self.post):
+            payload_size = 0
+            for index in range(self.other_objects):
+                client.put_object(Bucket=settings.S3[3], Key="other/{}.txt".format(index), Body=b"")
+            for index in range(self.bags):
+                payload_size += upload_bag(client, root, self.files, self.file_size, self.compressibility, str(index))[1]
+            return {routine.__name__: self.measure(routine, payload_size) for routine in ROUTINES}
+
+    def post(self, url, **kwargs):
+        """Answers requests to the rights and delivery services."""
+        time.sleep(self.service_latency)
+        return Mock(status_code=200, content=b'{"rights_statements": []}')
+
+    def measure(self, routine, payload_size):
+        """Runs a routine until it has nothing left to do.
+
+        Returns:
+            result (dict): time taken, bags processed, throughput and peak
+                memory allocated by Python.
+        """
+        tracemalloc.start()
+        start = time.perf_counter()
+        processed = 0
+        while True:
+            _, identifiers = routine().run()
+            if not identifiers:
+                break
+            processed += len(identifiers)
+        seconds = time.perf_counter() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        megabytes = payload_size / (1024 * 1024)
+        return {
+            "seconds": round(seconds, 3),
+            "processed": processed,
+            "megabytes": round(megabytes, 3),
+            "megabytes_per_second": round(megabytes / seconds, 3) if seconds else None,
+            "bags_per_minute": round(self.bags * 60 / seconds, 3) if seconds else None,
+            "peak_memory_megabytes": round(peak_memory / (1024 * 1024), 3)}
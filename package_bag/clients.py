@@ -0,0 +1,159 @@
+import time
+from threading import Lock
+from urllib.parse import urlsplit
+
+from requests import RequestException, Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from zorya import settings
+
+
+class CircuitOpenError(Exception):
+    """Raised when calls to a service are short-circuited because it is failing."""
+
+
+class CircuitBreaker(object):
+    """Stops calls to a service after repeated failures.
+
+    After `failure_threshold` consecutive failures the circuit opens, and calls
+    fail immediately for `reset_timeout` seconds. After that a single trial call
+    is let through: if it succeeds the circuit closes, otherwise it opens again.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError("Circuit open after {} consecutive failures".format(self.failures))
+            # Let this call through as a trial, holding off any others until it completes.
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class ServiceRetry(Retry):
+    """Retry policy which only repeats requests that are safe to repeat.
+
+    Idempotent requests are retried after read errors and 429, 502, 503 and
+    504 responses. Other requests, such as POSTs, may already have been acted
+    on, so are only retried after connection errors, which happen before the
+    request is sent, or when the service answers 429 or 503 with a Retry-After
+    header, asking for the request to be sent again. With `allowed_methods`
+    set to None, requests with any method are treated as idempotent.
+    """
+    RETRY_AFTER_STATUS_CODES = frozenset([429, 503])
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if self._is_method_retryable(method):
+            return super(ServiceRetry, self).is_retry(method, status_code, has_retry_after)
+        return bool(self.total and self.respect_retry_after_header and has_retry_after and status_code in self.RETRY_AFTER_STATUS_CODES)
+
+
+class ServiceClient(object):
+    """HTTP client for a single downstream service.
+
+    Requests share a session which keeps connections alive in a pool, are
+    subject to a timeout, and are retried with jittered exponential backoff
+    according to `ServiceRetry`. Requests which are safe to repeat whatever
+    their method, such as POSTs which only query the service, are sent through
+    a second session which retries them as it would idempotent requests.
+    Failures which remain after retrying are counted by a circuit breaker, and
+    bags whose requests fail are retried later by the routines.
+    """
+
+    def __init__(self):
+        self.session = self.create_session()
+        self.idempotent_session = self.create_session(allowed_methods=None)
+        self.circuit_breaker = CircuitBreaker(settings.CIRCUIT_BREAKER_THRESHOLD, settings.CIRCUIT_BREAKER_RESET_TIMEOUT)
+
+    def create_session(self, **retry_options):
+        retry = ServiceRetry(
+            total=settings.HTTP_RETRIES,
+            backoff_factor=settings.HTTP_BACKOFF_FACTOR,
+            backoff_jitter=settings.HTTP_BACKOFF_FACTOR,
+            status_forcelist=(429, 502, 503, 504),
+            raise_on_status=False,
+            **retry_options)
+        adapter = HTTPAdapter(pool_maxsize=settings.HTTP_POOL_SIZE, max_retries=retry)
+        session = Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def request(self, method, url, idempotent=False, **kwargs):
+        """Sends a request to the service.
+
+        Args:
+            method (str): HTTP method.
+            url (str): URL to send the request to.
+            idempotent (bool): whether the request is safe to repeat whatever
+                its method, so it is retried after read errors and server errors.
+            kwargs: arguments passed on to `requests.Session.request`.
+        """
+        self.circuit_breaker.before_call()
+        kwargs.setdefault("timeout", settings.HTTP_TIMEOUT)
+        session = self.idempotent_session if idempotent else self.session
+        try:
+            response = session.request(method, url, **kwargs)
+        except RequestException:
+            self.circuit_breaker.record_failure()
+            raise
+        if response.status_code >= 500:
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+        return response
+
+
+clients = {}
+clients_lock = Lock()
+
+
+def get_client(url):
+    """Returns the process-wide client for the service hosting a URL."""
+    service = urlsplit(url).netloc
+    with clients_lock:
+        if service not in clients:
+            clients[service] = ServiceClient()
+        return clients[service]
+
+
+def request(method, url, **kwargs):
+    """Sends a request through the client for the service hosting a URL."""
+    return get_client(url).request(method, url, **kwargs)
+
+
+def post(url, **kwargs):
+    """Sends a POST request through the client for the service hosting a URL.
+
+    POSTs are only retried when it is safe to, unless `idempotent=True` is
+    passed for a request which does not change anything on the service."""
+    return request("POST", url, **kwargs)
+
+
+def head(url, **kwargs):
+    """Sends a HEAD request through the client for the service hosting a URL."""
+    return request("HEAD", url, **kwargs)
+
+
+def put(url, **kwargs):
+    """Sends a PUT request through the client for the service hosting a URL."""
+    return request("PUT", url, **kwargs)
@@ -0,0 +1,242 @@
+import io
+import struct
+import tarfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os import walk
+from os.path import basename, getsize, join, splitext
+from shutil import rmtree
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+GZIP = "gzip"
+ZSTD = "zstd"
+EXTENSIONS = {GZIP: "gz", ZSTD: "zst"}
+
+GZIP_BLOCK_SIZE = 1024 * 1024
+DICTIONARY_SIZE = 32 * 1024
+
+# Files with these extensions are already compressed, so are not sampled
+COMPRESSED_EXTENSIONS = {
+    ".7z", ".bz2", ".flac", ".gif", ".gz", ".heic", ".j2k", ".jp2", ".jpeg", ".jpf", ".jpg", ".jpx",
+    ".m4a", ".m4v", ".mkv", ".mov", ".mp3", ".mp4", ".ogg", ".png", ".tgz", ".webm", ".webp",
+    ".xz", ".zip", ".zst"}
+SAMPLE_SIZE = 64 * 1024
+SAMPLED_FILES = 100
+# Compression strategies, chosen by the fraction of its size compression is estimated to save
+CHEAPEST_BELOW = 0.02
+FAST_BELOW = 0.1
+# Names of each format's cheapest, fast and default strategies. gzip can
+# store data uncompressed, but zstd always compresses, so its cheapest
+# strategy is its fastest level.
+STRATEGIES = {
+    GZIP: ("store", "fast", "default"),
+    ZSTD: ("fastest", "fast", "default"),
+}
+# Compression level of each strategy
+LEVELS = {
+    GZIP: {"store": 0, "fast": 1, "default": 6},
+    ZSTD: {"fastest": -5, "fast": 1, "default": 3},
+}
+
+
+def compress_block(block, dictionary, level):
+    """Compresses a block as raw deflate data which can be concatenated with the following blocks.
+
+    The block is primed with the end of the previous block, so matches can
+    refer back across block boundaries as they would in a single stream.
+    """
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """Writes a standard, single member gzip stream, compressing blocks of data in parallel.
+
+    Data is split into blocks which are compressed independently by a pool of
+    threads and written in order, each ending on a byte boundary so the
+    compressed blocks form one deflate stream. zlib releases the GIL while
+    compressing, so blocks are compressed on as many cores as there are workers.
+
+    Args:
+        fileobj (file): a binary file to write the compressed stream to. It is
+            left open when the writer is closed.
+        level (int): zlib compression level.
+        workers (int): number of threads compressing blocks.
+        block_size (int): size of uncompressed blocks, in bytes.
+    """
+
+    def __init__(self, fileobj, level=6, workers=1, block_size=GZIP_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = workers * 2
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.dictionary = b""
+        self.crc = 0
+        self.size = 0
+        xfl = 2 if level == 9 else 4 if level == 1 else 0
+        self.fileobj.write(b"\x1f\x8b\x08\x00" + struct.pack("<I", int(time.time())) + bytes([xfl, 255]))
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def submit(self, block):
+        self.pending.append(self.executor.submit(compress_block, block, self.dictionary, self.level))
+        self.dictionary = block[-DICTIONARY_SIZE:]
+        while len(self.pending) >= self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer:
+                self.submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+            self.fileobj.write(zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+            self.fileobj.write(struct.pack("<II", self.crc, self.size & 0xffffffff))
+        finally:
+            self.executor.shutdown()
+            super(ParallelGzipWriter, self).close()
+
+
+class StreamWriter(io.RawIOBase):
+    """Write-only view of an open file, which leaves the file open when closed."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.fileobj.write(data)
+
+
+def compressed_writer(fileobj, compression=GZIP, level=None, workers=1):
+    """Returns a writer which compresses data written to it into a file.
+
+    Args:
+        fileobj (file): a binary file to write compressed data to.
+        compression (str): compression format, either gzip or zstd.
+        level (int): compression level, or None for the format's default.
+        workers (int): number of threads to compress with.
+
+    Returns:
+        writer (file): a writable file object. The underlying file is left open
+            when the writer is closed.
+    """
+    if compression == GZIP:
+        return ParallelGzipWriter(fileobj, 6 if level is None else level, workers)
+    if compression == ZSTD:
+        if zstandard is None:
+            raise Exception("zstd compression requires the zstandard package.")
+        compressor = zstandard.ZstdCompressor(level=3 if level is None else level, threads=workers)
+        return compressor.stream_writer(StreamWriter(fileobj), closefd=False)
+    raise Exception("Unknown compression format {}".format(compression))
+
+
+def write_tarfile(fileobj, source_dir, compression=GZIP, level=None, workers=1):
+    """Writes a compressed TAR of a directory to an open file."""
+    with compressed_writer(fileobj, compression, level, workers) as writer:
+        with tarfile.open(fileobj=writer, mode="w|") as tf:
+            tf.add(source_dir, arcname=basename(source_dir))
+
+
+def make_tarfile(source_dir, output_filename, compression=GZIP, level=None, workers=1, remove_src=False):
+    """Creates a compressed TAR of a directory.
+
+    Args:
+        source_dir (str): path of the directory to archive.
+        output_filename (str): path of the archive to create.
+        compression (str): compression format, either gzip or zstd.
+        level (int): compression level, or None for the format's default.
+        workers (int): number of threads to compress with.
+        remove_src (bool): whether to remove the directory once it is archived.
+    """
+    with open(output_filename, "wb") as f:
+        write_tarfile(f, source_dir, compression, level, workers)
+    if remove_src:
+        rmtree(source_dir)
+
+
+def estimate_saving(source_dir):
+    """Estimates the fraction of its size compression would save for a directory.
+
+    Files with extensions in COMPRESSED_EXTENSIONS are assumed to save
+    nothing. The start of the largest other files is compressed at a fast
+    level, and the ratio measured is extrapolated to all other files.
+
+    Returns:
+        saving (float): estimated fraction of the directory's size saved.
+    """
+    total_size = 0
+    candidates = []
+    for root, _, files in walk(source_dir):
+        for name in files:
+            path = join(root, name)
+            size = getsize(path)
+            total_size += size
+            if splitext(name)[1].lower() not in COMPRESSED_EXTENSIONS:
+                candidates.append((size, path))
+    if not total_size:
+        return 0.0
+    sampled_size = compressed_size = 0
+    for size, path in sorted(candidates, reverse=True)[:SAMPLED_FILES]:
+        with open(path, "rb") as f:
+            sample = f.read(SAMPLE_SIZE)
+        sampled_size += len(sample)
+        compressed_size += len(zlib.compress(sample, 1))
+    if not sampled_size:
+        return 0.0
+    candidates_size = sum(size for size, _ in candidates)
+    return max(0.0, 1 - compressed_size / sampled_size) * candidates_size / total_size
+
+
+def choose_compression(source_dir, compression=GZIP):
+    """Chooses how hard to compress a directory, based on how compressible it is.
+
+    Directories which would barely shrink get the format's cheapest strategy,
+    which for gzip stores them without compression, and those which would
+    shrink a little are compressed at a fast level.
+
+    Returns:
+        decision (dict): the compression format, strategy and level, and the
+            estimated saving the choice was based on.
+    """
+    saving = estimate_saving(source_dir)
+    cheapest, fast, default = STRATEGIES[compression]
+    if saving < CHEAPEST_BELOW:
+        strategy = cheapest
+    elif saving < FAST_BELOW:
+        strategy = fast
+    else:
+        strategy = default
+    return {
+        "format": compression,
+        "strategy": strategy,
+        "level": LEVELS[compression][strategy],
+        "estimated_saving": round(saving, 4)}
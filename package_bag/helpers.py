@@ -1,3 +1,26 @@
+import bz2
+import gzip
+import hashlib
+import io
+import logging
+import lzma
+import re
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs, utime, walk
+from os.path import dirname, exists, getsize, isabs, isdir, join
+
+import bagit
+
+from package_bag import json_codec
+from package_bag.compression import EXTENSIONS, GZIP, write_tarfile
+
+logger = logging.getLogger(__name__)
+
+HASH_BLOCK_SIZE = 1024 * 1024
+# Bag metadata which determines the package made from a bag
+FINGERPRINT_FIELDS = ["Origin", "Rights-ID", "Start-Date", "End-Date"]
 
 
 def expected_file_name(filename):
@@ -15,3 +38,416 @@ def expected_file_name(filename):
         return True
     else:
         return False
+
+
+class ETagHasher(object):
+    """Incrementally calculates the ETag S3 assigns to an object.
+
+    Objects uploaded in a single request have the MD5 of their content as
+    ETag, while multipart uploads have the MD5 of the concatenated MD5 digests
+    of each part, followed by the number of parts.
+
+    Args:
+        part_size (int): size of the parts the object was uploaded in, or None
+            if the object was uploaded in a single request.
+    """
+
+    def __init__(self, part_size=None):
+        self.part_size = part_size
+        self.part_hash = hashlib.md5()
+        self.part_bytes = 0
+        self.part_digests = []
+
+    def update(self, data):
+        if not self.part_size:
+            self.part_hash.update(data)
+            return
+        data = memoryview(data)
+        while data:
+            chunk = data[:self.part_size - self.part_bytes]
+            self.part_hash.update(chunk)
+            self.part_bytes += len(chunk)
+            data = data[len(chunk):]
+            if self.part_bytes == self.part_size:
+                self.part_digests.append(self.part_hash.digest())
+                self.part_hash = hashlib.md5()
+                self.part_bytes = 0
+
+    def hexdigest(self):
+        if not self.part_size:
+            return self.part_hash.hexdigest()
+        digests = self.part_digests + ([self.part_hash.digest()] if self.part_bytes else [])
+        return "{}-{}".format(hashlib.md5(b"".join(digests)).hexdigest(), len(digests))
+
+
+class HashingReader(object):
+    """File-like wrapper which feeds all data read from a stream to hashers.
+
+    Args:
+        fileobj (file-like): stream to read from
+        hashers (list): objects with an `update` method
+    """
+
+    def __init__(self, fileobj, hashers):
+        self.fileobj = fileobj
+        self.hashers = hashers
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        for hasher in self.hashers:
+            hasher.update(data)
+        return data
+
+
+def manifest_algorithms(names):
+    """Returns the checksum algorithms of the manifests in a tarred bag
+
+    Args:
+        names (list): names of the members of a tarfile containing a single bag
+
+    Returns:
+        algorithms (list): checksum algorithm names"""
+    algorithms = set()
+    for name in names:
+        match = re.match(r"^[^/]+/(tag)?manifest-(\w+)\.txt$", name.strip("/"))
+        if match:
+            algorithms.add(match.group(2))
+    return sorted(algorithms)
+
+
+def extract_bag(tf, bag_path, algorithms=None):
+    """Extracts a tarred bag to a directory, stripping its top-level directory.
+
+    Members are extracted in the order they appear in the archive, so this
+    works for archives opened in stream mode. If checksum algorithms are given,
+    files are hashed as they are written so that the bag's fixity can be
+    verified without reading its contents again.
+
+    Args:
+        tf (tarfile.TarFile): an open tarfile containing a single bag
+        bag_path (str): directory to extract the bag's contents to
+        algorithms (list): checksum algorithms to calculate for each file
+
+    Returns:
+        checksums (dict): hexdigests keyed by algorithm, keyed by file path relative to the bag"""
+    makedirs(bag_path)
+    checksums = {}
+    for member in tf:
+        relative_path = member.name.strip("/").split("/", 1)[1:]
+        if not relative_path:
+            continue
+        relative_path = relative_path[0]
+        if isabs(relative_path) or ".." in relative_path.split("/"):
+            raise Exception("Unsafe path in archive: {}".format(member.name))
+        target = join(bag_path, relative_path)
+        if member.isdir():
+            makedirs(target, exist_ok=True)
+        elif member.isfile():
+            makedirs(dirname(target), exist_ok=True)
+            hashers = {alg: hashlib.new(alg) for alg in algorithms or []}
+            source = tf.extractfile(member)
+            with open(target, "wb") as f:
+                while True:
+                    block = source.read(HASH_BLOCK_SIZE)
+                    if not block:
+                        break
+                    f.write(block)
+                    for hasher in hashers.values():
+                        hasher.update(block)
+            utime(target, (member.mtime, member.mtime))
+            if hashers:
+                checksums[relative_path] = {alg: hasher.hexdigest() for alg, hasher in hashers.items()}
+        else:
+            raise Exception("Unsupported member type in archive: {}".format(member.name))
+    return checksums
+
+
+def is_compressed(tf):
+    """Returns true if a tarfile is read through a decompressor
+
+    Going back to an earlier member of a compressed tarfile means decompressing
+    it again from the start, as does reading every header before extracting."""
+    return isinstance(tf.fileobj, (gzip.GzipFile, bz2.BZ2File, lzma.LZMAFile))
+
+
+def read_tags(tf, member, encoding="utf-8-sig"):
+    """Reads a tag file from a tarfile without extracting it
+
+    Returns:
+        tags (dict): tag values keyed by tag name, as lists for repeated tags"""
+    tags = {}
+    with io.TextIOWrapper(tf.extractfile(member), encoding=encoding) as f:
+        for name, value in bagit._parse_tags(f):
+            if name not in tags:
+                tags[name] = value
+            elif isinstance(tags[name], list):
+                tags[name].append(value)
+            else:
+                tags[name] = [tags[name], value]
+    return tags
+
+
+def precheck_bag(tf, profiles):
+    """Checks a tarred bag's structure and metadata without extracting it
+
+    Only the tar member headers and the bagit.txt and bag-info.txt files are
+    read, so malformed bags are rejected before any payload is written to disk.
+    Reaching the last header of a compressed tarfile decompresses all of it,
+    so this is only cheap for uncompressed tarfiles.
+
+    Args:
+        tf (tarfile.TarFile): an open tarfile containing a single bag
+        profiles (ProfileRegistry): registry of the BagIt profiles bags should conform to
+
+    Raises:
+        bagit.BagValidationError: if the bag is malformed"""
+    members = {}
+    for member in tf.getmembers():
+        relative_path = member.name.strip("/").split("/", 1)[1:]
+        if relative_path:
+            members[relative_path[0]] = member
+    missing = [tag_file for tag_file in ["bagit.txt", "bag-info.txt"] if tag_file not in members]
+    if missing:
+        raise bagit.BagValidationError("Bag precheck failed: {} not present".format(", ".join(missing)))
+
+    errors = []
+    bagit_tags = read_tags(tf, members["bagit.txt"])
+    bag_info = read_tags(tf, members["bag-info.txt"], bagit_tags.get("Tag-File-Character-Encoding", "utf-8"))
+    origin = bag_info.get("Origin")
+    profile = profiles.get(origin if isinstance(origin, str) else None).profile
+    if bagit_tags.get("BagIt-Version") not in profile.get("Accept-BagIt-Version", [bagit_tags.get("BagIt-Version")]):
+        errors.append("BagIt version {} is not accepted".format(bagit_tags.get("BagIt-Version")))
+    if not any(re.match(r"^manifest-\w+\.txt$", name) for name in members):
+        errors.append("No manifest files found")
+    for alg in profile.get("Manifests-Required", []):
+        if "manifest-{}.txt".format(alg) not in members:
+            errors.append("Required manifest-{}.txt not found".format(alg))
+    profile_identifier = profile["BagIt-Profile-Info"]["BagIt-Profile-Identifier"]
+    if bag_info.get("BagIt-Profile-Identifier") != profile_identifier:
+        errors.append("BagIt-Profile-Identifier is not {}".format(profile_identifier))
+    for tag, config in profile.get("Bag-Info", {}).items():
+        if tag not in bag_info:
+            if config.get("required"):
+                errors.append("Required tag {} not present in bag-info.txt".format(tag))
+        elif "values" in config and bag_info[tag] not in config["values"]:
+            errors.append("Tag {} has a value which is not allowed: {}".format(tag, bag_info[tag]))
+        elif config.get("repeatable") is False and isinstance(bag_info[tag], list):
+            errors.append("Tag {} is not repeatable".format(tag))
+
+    oxum = bag_info.get("Payload-Oxum")
+    if isinstance(oxum, str):
+        payload = [member for name, member in members.items() if name.startswith("data/") and member.isfile()]
+        found = "{}.{}".format(sum(member.size for member in payload), len(payload))
+        if oxum != found:
+            errors.append("Payload-Oxum validation failed: expected {} but found {}".format(oxum, found))
+
+    if errors:
+        raise bagit.BagValidationError("Bag precheck failed: {}".format("; ".join(errors)))
+
+
+def calculate_checksums(bag, workers=1):
+    """Calculates checksums for all files listed in a bag's manifests
+
+    Files are hashed by a pool of threads, which run in parallel since hashlib
+    releases the GIL while hashing large blocks.
+
+    Args:
+        bag (bagit.Bag): the bag to calculate checksums for
+        workers (int): number of files to hash concurrently
+
+    Returns:
+        checksums (dict): hexdigests keyed by algorithm, keyed by file path relative to the bag"""
+    def calculate(rel_path):
+        hashers = {alg: hashlib.new(alg) for alg in bag.entries[rel_path]}
+        rel_path = bag.normalized_filesystem_names.get(rel_path, rel_path)
+        with open(join(bag.path, rel_path), "rb") as f:
+            while True:
+                block = f.read(HASH_BLOCK_SIZE)
+                if not block:
+                    break
+                for hasher in hashers.values():
+                    hasher.update(block)
+        return rel_path, {alg: hasher.hexdigest() for alg, hasher in hashers.items()}
+
+    checksums = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for count, (rel_path, digests) in enumerate(executor.map(calculate, bag.entries), 1):
+            checksums[rel_path] = digests
+            logger.info("Calculated checksums for %s (%d of %d files)", rel_path, count, len(bag.entries))
+    return checksums
+
+
+def verify_checksums(bag, checksums):
+    """Compares calculated checksums against those in a bag's manifests
+
+    Args:
+        bag (bagit.Bag): the bag to verify
+        checksums (dict): hexdigests keyed by algorithm, keyed by file path relative to the bag
+
+    Raises:
+        bagit.BagValidationError: if any checksum does not match"""
+    errors = []
+    for rel_path, hashes in bag.entries.items():
+        for alg, expected in hashes.items():
+            found = checksums.get(bag.normalized_filesystem_names.get(rel_path, rel_path), {}).get(alg)
+            if expected.lower() != found:
+                errors.append(bagit.ChecksumMismatch(rel_path, alg, expected.lower(), found))
+    if errors:
+        raise bagit.BagValidationError("Bag validation failed", errors)
+
+
+def validate_bag(bag_path, workers=1, checksums=None):
+    """Validates the structure, completeness and fixity of a bag
+
+    Args:
+        bag_path (str): full path to the bag directory
+        workers (int): number of files to hash concurrently
+        checksums (dict): checksums already calculated for the bag's files, for
+            example while extracting them. If not provided, or not calculated
+            with every algorithm the bag's manifests use, files are hashed.
+
+    Returns:
+        bag (bagit.Bag): the validated bag"""
+    bag = bagit.Bag(bag_path)
+    bag.validate(completeness_only=True)
+    if checksums is None or not set(bag.algorithms) <= {alg for hashes in checksums.values() for alg in hashes}:
+        checksums = calculate_checksums(bag, workers)
+    verify_checksums(bag, checksums)
+    return bag
+
+
+def payload_fingerprint(bag):
+    """Returns a fingerprint of a bag's payload and the metadata its package is made from
+
+    The payload is identified by the paths and checksums in the bag's
+    manifests, so no files are read. Bags with the same fingerprint produce
+    the same package, whatever they were named when uploaded.
+
+    Args:
+        bag (bagit.Bag): a validated bag
+
+    Returns:
+        fingerprint (str): a SHA-256 hex digest"""
+    hasher = hashlib.sha256()
+    for path, checksums in sorted(bag.payload_entries().items()):
+        for algorithm, checksum in sorted(checksums.items()):
+            hasher.update("{} {} {}\n".format(algorithm, checksum, path).encode("utf-8"))
+    for field in FINGERPRINT_FIELDS:
+        hasher.update("{}: {}\n".format(field, bag.info.get(field)).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def path_size(path):
+    """Returns the size of a file or the total size of the files in a directory.
+
+    Args:
+        path (str): path to a file or directory.
+
+    Returns:
+        size (int): size in bytes, or 0 if the path does not exist.
+    """
+    if not path or not exists(path):
+        return 0
+    if not isdir(path):
+        return getsize(path)
+    return sum(getsize(join(root, name)) for root, _, files in walk(path) for name in files)
+
+
+def bag_size(path):
+    """Returns the size of a bag without walking its files.
+
+    The size of a tarred bag is the size of its file. The size of a bag
+    directory is the payload size in the Payload-Oxum tag of its bag-info.txt.
+
+    Args:
+        path (str): path to a tarred bag or a bag directory.
+
+    Returns:
+        size (int): size in bytes, or 0 if the path does not exist or the bag
+            has no Payload-Oxum.
+    """
+    if not path or not exists(path):
+        return 0
+    if not isdir(path):
+        return getsize(path)
+    bag_info = join(path, "bag-info.txt")
+    if not exists(bag_info):
+        return 0
+    with open(bag_info, "r", encoding="utf-8-sig") as f:
+        for name, value in bagit._parse_tags(f):
+            if name == "Payload-Oxum":
+                octets = value.split(".", 1)[0]
+                return int(octets) if octets.isdigit() else 0
+    return 0
+
+
+def tar_info(name, mtime, type=tarfile.REGTYPE, mode=0o644, size=0):
+    info = tarfile.TarInfo(name)
+    info.type = type
+    info.mode = mode
+    info.mtime = mtime
+    info.size = size
+    return info
+
+
+def write_tar_header(f, info):
+    f.write(info.tobuf(tarfile.GNU_FORMAT, "utf-8", "surrogateescape"))
+
+
+def pad_tar_block(f, size):
+    remainder = size % tarfile.BLOCKSIZE
+    if remainder:
+        f.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+
+def write_streamed_member(f, info, write):
+    """Writes a TAR member whose size is not known until it has been written.
+
+    The member's header is written with a placeholder size, then `write` is
+    called with the file to write the member's data, and the header is
+    rewritten with the size of the data written.
+
+    Args:
+        f (file): a seekable binary file, positioned where the member starts.
+        info (tarfile.TarInfo): the member's header.
+        write (callable): writes the member's data to the file it is passed.
+    """
+    header_offset = f.tell()
+    write_tar_header(f, info)
+    data_offset = f.tell()
+    write(f)
+    info.size = f.tell() - data_offset
+    pad_tar_block(f, info.size)
+    end_offset = f.tell()
+    f.seek(header_offset)
+    write_tar_header(f, info)
+    f.seek(end_offset)
+
+
+def write_package(package_path, root, bag_path, bag_data, compression=GZIP, level=None, workers=1, pretty=False):
+    """Writes a delivery package in a single pass.
+
+    The package is an uncompressed TAR containing a directory named `root`,
+    which holds the bag's JSON and the bag itself as a compressed TAR. Both
+    are streamed straight into the package.
+
+    Args:
+        package_path (str): path at which to write the package.
+        root (str): name of the directory in the package.
+        bag_path (str): path of the bag directory.
+        bag_data (dict): data to serialize as the bag's JSON.
+        compression (str): compression format for the bag, either gzip or zstd.
+        level (int): compression level, or None for the format's default.
+        workers (int): number of threads to compress the bag with.
+        pretty (bool): whether to indent the JSON.
+    """
+    mtime = time.time()
+    with open(package_path, "wb") as f:
+        write_tar_header(f, tar_info(root, mtime, type=tarfile.DIRTYPE, mode=0o755))
+        write_streamed_member(
+            f, tar_info(join(root, "{}.json".format(root)), mtime),
+            lambda f: json_codec.dump(bag_data, f, pretty))
+        write_streamed_member(
+            f, tar_info(join(root, "{}.tar.{}".format(root, EXTENSIONS[compression])), mtime),
+            lambda f: write_tarfile(f, bag_path, compression, level, workers))
+        f.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
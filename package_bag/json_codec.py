@@ -0,0 +1,81 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+def encode_default(obj):
+    """Encodes objects JSON has no type for: dates and times in ISO 8601, anything else as a string."""
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    return str(obj)
+
+
+# Pretty JSON is indented by four spaces, as package JSON always has been.
+# orjson can only indent by two, so pretty JSON is always encoded by the
+# standard library.
+PRETTY_OPTIONS = {"indent": 4, "sort_keys": True, "default": str}
+# Options which make the standard library encode compact JSON as orjson does
+COMPACT_OPTIONS = {"separators": (",", ":"), "sort_keys": True, "ensure_ascii": False, "default": encode_default}
+
+
+def dumps(obj, pretty=False):
+    """Encodes an object as JSON, with sorted keys.
+
+    Compact JSON is encoded by orjson if it is installed, and otherwise by the
+    standard library, which produces identical output. Pretty JSON is always
+    encoded by the standard library. Objects which cannot otherwise be
+    encoded, such as dates, are encoded as strings.
+
+    Args:
+        obj: the object to encode.
+        pretty (bool): whether to indent the JSON.
+
+    Returns:
+        data (bytes): UTF-8 encoded JSON.
+    """
+    if pretty:
+        return json.dumps(obj, **PRETTY_OPTIONS).encode("utf-8")
+    if orjson is not None:
+        option = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        return orjson.dumps(obj, default=encode_default, option=option)
+    return json.dumps(obj, **COMPACT_OPTIONS).encode("utf-8")
+
+
+def dump(obj, fileobj, pretty=False):
+    """Writes an object as JSON to a binary file.
+
+    With the standard library, which encodes all pretty JSON, the JSON is
+    encoded and written in chunks, so a complete copy of it is never held in
+    memory.
+
+    Args:
+        obj: the object to encode.
+        fileobj (file): a binary file to write to.
+        pretty (bool): whether to indent the JSON.
+    """
+    if orjson is not None and not pretty:
+        fileobj.write(dumps(obj))
+        return
+    encoder = json.JSONEncoder(**(PRETTY_OPTIONS if pretty else COMPACT_OPTIONS))
+    buffer = []
+    size = 0
+    for chunk in encoder.iterencode(obj):
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= WRITE_CHUNK_SIZE:
+            fileobj.write("".join(buffer).encode("utf-8"))
+            buffer = []
+            size = 0
+    fileobj.write("".join(buffer).encode("utf-8"))
+
+
+def loads(data):
+    """Decodes JSON from bytes or a string."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,65 @@
+import json
+import subprocess
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand
+
+from package_bag.benchmarks import Benchmark, throwaway_database
+
+COLUMNS = ["seconds", "megabytes_per_second", "bags_per_minute", "peak_memory_megabytes"]
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = "Runs every routine over synthetic bags and reports throughput and peak memory."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bags", type=int, default=10, help="Number of bags")
+        parser.add_argument("--files", type=int, default=100, help="Number of payload files in each bag")
+        parser.add_argument("--file-size", type=int, default=1024 * 1024, help="Size of each payload file, in bytes")
+        parser.add_argument("--compressibility", type=float, default=0.5, help="Fraction of each payload file which is compressible")
+        parser.add_argument("--other-objects", type=int, default=1000, help="Number of objects in the bucket which are not bags")
+        parser.add_argument("--service-latency", type=float, default=0.05, help="Seconds taken by each request to the rights and delivery services")
+        parser.add_argument("--output", help="Path of a JSON file to save results to")
+        parser.add_argument("--compare", help="Path of a JSON file of earlier results to compare against")
+
+    def handle(self, *args, **options):
+        benchmark = Benchmark(
+            options["bags"], options["files"], options["file_size"], options["compressibility"],
+            options["other_objects"], options["service_latency"])
+        report = {
+            "commit": current_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "parameters": benchmark.parameters}
+        with throwaway_database():
+            report["results"] = benchmark.run()
+        baseline = None
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                baseline = json.load(f)
+            if baseline["parameters"] != report["parameters"]:
+                self.stderr.write("Warning: results being compared were run with different parameters.")
+        self.stdout.write(self.format_report(report, baseline))
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=4)
+
+    def format_report(self, report, baseline=None):
+        """Formats results as a table, with the change from a baseline for each measurement if given."""
+        lines = ["{:<20}".format("routine") + "".join("{:>32}".format(column) for column in COLUMNS)]
+        for routine, result in report["results"].items():
+            cells = []
+            for column in COLUMNS:
+                cell = "{}".format(result[column])
+                previous = baseline["results"].get(routine, {}).get(column) if baseline else None
+                if previous and result[column] is not None:
+                    cell += " ({:+.1%})".format(result[column] / previous - 1)
+                cells.append("{:>32}".format(cell))
+            lines.append("{:<20}".format(routine) + "".join(cells))
+        return "\n".join(lines)
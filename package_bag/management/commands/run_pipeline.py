@@ -0,0 +1,107 @@
+import logging
+import signal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Thread
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+
+from package_bag.metrics import registry
+from package_bag.routines import (BagDiscoverer, PackageArchiver,
+                                  PackageDeliverer, PackageMaker,
+                                  RightsAssigner, S3ObjectDownloader,
+                                  S3ObjectFinder)
+
+logger = logging.getLogger(__name__)
+
+PIPELINE = [
+    S3ObjectFinder,
+    S3ObjectDownloader,
+    BagDiscoverer,
+    RightsAssigner,
+    PackageMaker,
+    PackageArchiver,
+    PackageDeliverer,
+]
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves metrics for the pipeline process in the Prometheus text exposition format."""
+
+    def do_GET(self):
+        try:
+            body = registry.render().encode("utf-8")
+        finally:
+            connections.close_all()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class Command(BaseCommand):
+    help = "Runs all routines continuously, passing bags from one stage to the next as soon as they are ready."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--min-sleep", type=float, default=1, help="Seconds to sleep after the first idle pass")
+        parser.add_argument("--max-sleep", type=float, default=60, help="Maximum seconds to sleep between idle passes")
+        parser.add_argument("--once", action="store_true", help="Run a single pass through the pipeline and exit")
+        parser.add_argument("--metrics-port", type=int, help="Port on which to serve metrics for the pipeline")
+
+    def handle(self, *args, **options):
+        self.stopping = Event()
+        server = None
+        if options["metrics_port"]:
+            server = ThreadingHTTPServer(("", options["metrics_port"]), MetricsHandler)
+            Thread(target=server.serve_forever, daemon=True).start()
+        handlers = {signum: signal.signal(signum, self.stop) for signum in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            sleep = 0
+            while not self.stopping.is_set():
+                if self.run_pass():
+                    sleep = 0
+                else:
+                    sleep = min(max(sleep * 2, options["min_sleep"]), options["max_sleep"])
+                if options["once"]:
+                    break
+                self.stopping.wait(sleep)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            if server:
+                server.shutdown()
+                server.server_close()
+        self.stdout.write("Pipeline stopped.")
+
+    def stop(self, signum, frame):
+        """Stops the pipeline once the routine currently running has finished."""
+        logger.info("Received signal %d, stopping pipeline", signum)
+        self.stopping.set()
+
+    def run_pass(self):
+        """Runs each routine in pipeline order.
+
+        Since each routine picks up bags left by the one before it, a bag can
+        move through several stages in a single pass.
+
+        Returns:
+            busy (bool): True if any routine processed a bag.
+        """
+        busy = False
+        for routine in PIPELINE:
+            if self.stopping.is_set():
+                break
+            close_old_connections()
+            try:
+                msg, identifiers = routine().run()
+            except Exception as e:
+                logger.exception("%s failed: %s", routine.__name__, e)
+                continue
+            if identifiers:
+                busy = True
+                logger.info("%s: %s %s", routine.__name__, msg, ", ".join(identifiers))
+        return busy
@@ -0,0 +1,35 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from package_bag.benchmarks import throwaway_database
+from package_bag.simulation import Simulation
+
+
+class Command(BaseCommand):
+    help = "Drives synthetic bags through every routine against local stand-ins for S3 and the rights and delivery services."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bags", type=int, default=20, help="Number of bags")
+        parser.add_argument("--files", type=int, default=10, help="Number of payload files in each bag")
+        parser.add_argument("--file-size", type=int, default=64 * 1024, help="Size of each payload file, in bytes")
+        parser.add_argument("--compressibility", type=float, default=0.5, help="Fraction of each payload file which is compressible")
+        parser.add_argument("--arrival-interval", type=float, default=0, help="Seconds between bags being uploaded")
+        parser.add_argument("--rights-latency", type=float, default=0.1, help="Mean seconds taken by the rights service")
+        parser.add_argument("--delivery-latency", type=float, default=0.1, help="Mean seconds taken by the delivery service")
+        parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests to each service which fail")
+        parser.add_argument("--retry-backoff", type=float, default=1, help="Seconds before a bag which failed is retried, doubled after each further failure")
+        parser.add_argument("--timeout", type=float, default=600, help="Seconds after which to stop")
+        parser.add_argument("--output", help="Path of a JSON file to save results to")
+
+    def handle(self, *args, **options):
+        simulation = Simulation(
+            options["bags"], options["files"], options["file_size"], options["compressibility"],
+            options["arrival_interval"], options["rights_latency"], options["delivery_latency"],
+            options["error_rate"], options["timeout"], options["retry_backoff"])
+        with throwaway_database():
+            report = {"parameters": simulation.parameters, "results": simulation.run()}
+        self.stdout.write(json.dumps(report, indent=4))
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=4)
@@ -0,0 +1,178 @@
+import math
+from threading import Lock
+
+from django.core.cache import cache
+from django.db.models import Count
+
+from zorya import settings
+
+from .models import Bag
+
+DURATION_BUCKETS = (0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600)
+QUEUE_DEPTH_CACHE_KEY = "queue-depth"
+
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{{{}}}".format(",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in pairs))
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """Base class for metrics, which hold a value for each combination of label values."""
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = Lock()
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.type)]
+        with self.lock:
+            for labelvalues, value in sorted(self.values.items()):
+                lines.extend(self.render_value(labelvalues, value))
+        return lines
+
+    def render_value(self, labelvalues, value):
+        return ["{}{} {}".format(self.name, format_labels(self.labelnames, labelvalues), format_value(value))]
+
+
+class Counter(Metric):
+    """A value which only goes up."""
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value which can be set to anything."""
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    """Counts observations in cumulative buckets, and tracks their sum."""
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    def render_value(self, labelvalues, value):
+        counts, total = value
+        lines = [
+            "{}_bucket{} {}".format(self.name, format_labels(self.labelnames, labelvalues, [("le", format_value(bound))]), count)
+            for bound, count in zip(self.buckets, counts)]
+        lines.append("{}_sum{} {}".format(self.name, format_labels(self.labelnames, labelvalues), format_value(total)))
+        lines.append("{}_count{} {}".format(self.name, format_labels(self.labelnames, labelvalues), counts[-1]))
+        return lines
+
+
+class Registry(object):
+    """Holds the metrics recorded by this process.
+
+    Collectors are functions called before metrics are rendered, which can be
+    used to update gauges from the current state of the database.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self, collector):
+        self.collectors.append(collector)
+        return collector
+
+    def render(self):
+        """Returns metrics in the Prometheus text exposition format."""
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+ROUTINE_RUNS = registry.register(Counter(
+    "zorya_routine_runs_total", "Routine runs, by outcome.", ["routine", "outcome"]))
+ROUTINE_RUN_SECONDS = registry.register(Histogram(
+    "zorya_routine_run_seconds", "Time taken by routine runs.", ["routine"]))
+BAGS_PROCESSED = registry.register(Counter(
+    "zorya_bags_processed_total", "Bags processed by routines, by outcome.", ["routine", "outcome"]))
+BAG_PROCESS_SECONDS = registry.register(Histogram(
+    "zorya_bag_process_seconds", "Time taken to process a bag.", ["routine"]))
+BYTES_PROCESSED = registry.register(Counter(
+    "zorya_bytes_processed_total", "Size of bags processed by routines.", ["routine"]))
+QUEUE_DEPTH = registry.register(Gauge(
+    "zorya_bags", "Bags in each process status.", ["status", "name"]))
+
+
+def queue_depth():
+    """Counts bags in each process status and from each origin.
+
+    Counts come from a single grouped query, and are cached for
+    `settings.QUEUE_DEPTH_CACHE_TIMEOUT` seconds so frequent polling is cheap.
+
+    Returns:
+        depth (dict): the total number of bags, the number from each origin,
+            and for each process status the number of bags and the number from
+            each origin.
+    """
+    depth = cache.get(QUEUE_DEPTH_CACHE_KEY)
+    if depth is None:
+        statuses = {status: {"process_status": status, "name": name, "count": 0, "origins": {}} for status, name in Bag.PROCESS_STATUS_CHOICES}
+        origins = {}
+        for status, origin, count in Bag.objects.values_list("process_status", "origin").annotate(Count("pk")).order_by():
+            status_depth = statuses.setdefault(status, {"process_status": status, "name": None, "count": 0, "origins": {}})
+            status_depth["count"] += count
+            if origin:
+                status_depth["origins"][origin] = status_depth["origins"].get(origin, 0) + count
+                origins[origin] = origins.get(origin, 0) + count
+        depth = {
+            "total": sum(status_depth["count"] for status_depth in statuses.values()),
+            "origins": origins,
+            "process_statuses": list(statuses.values())}
+        cache.set(QUEUE_DEPTH_CACHE_KEY, depth, settings.QUEUE_DEPTH_CACHE_TIMEOUT)
+    return depth
+
+
+@registry.collect
+def collect_queue_depth():
+    for status_depth in queue_depth()["process_statuses"]:
+        QUEUE_DEPTH.set(status_depth["count"], status=status_depth["process_status"], name=status_depth["name"])
@@ -0,0 +1,31 @@
+from os.path import basename
+
+from django.db import migrations
+
+
+def normalize_original_bag_name(apps, schema_editor):
+    """Strips directory paths saved with some original bag names.
+
+    S3ObjectFinder now looks up exact S3 object keys, so names saved as full
+    paths would no longer be recognized. Names which would collide with an
+    existing name are left unchanged.
+    """
+    Bag = apps.get_model("package_bag", "Bag")
+    seen = set(Bag.objects.values_list("original_bag_name", flat=True))
+    for bag in Bag.objects.filter(original_bag_name__contains="/").order_by("pk"):
+        name = basename(bag.original_bag_name)
+        if name and name not in seen:
+            seen.add(name)
+            bag.original_bag_name = name
+            bag.save(update_fields=["original_bag_name"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('package_bag', '0009_alter_bag_process_status'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_original_bag_name, migrations.RunPython.noop),
+    ]
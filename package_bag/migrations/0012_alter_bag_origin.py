@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 11:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('package_bag', '0011_alter_bag_original_bag_name_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='bag',
+            name='origin',
+            field=models.CharField(blank=True, choices=[('legacy_digital', 'Legacy Digital Processing'), ('digitization', 'Digitization'), ('av_digitization', 'Audiovisual Digitization')], max_length=20, null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.16 on 2026-10-18 16:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('package_bag', '0012_alter_bag_origin'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bag',
+            index=models.Index(fields=['process_status', 'id'], name='bag_process_status_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bag',
+            index=models.Index(fields=['origin', 'id'], name='bag_origin_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bag',
+            index=models.Index(fields=['created'], name='bag_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bag',
+            index=models.Index(fields=['last_modified'], name='bag_last_modified_idx'),
+        ),
+    ]
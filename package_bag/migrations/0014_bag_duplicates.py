@@ -0,0 +1,42 @@
+# Generated by Django 4.2.16 on 2026-10-18 18:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('package_bag', '0013_bag_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bag',
+            name='s3_etag',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='bag',
+            name='payload_fingerprint',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='bag',
+            name='duplicate_of',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='package_bag.bag'),
+        ),
+        migrations.AlterField(
+            model_name='bag',
+            name='process_status',
+            field=models.IntegerField(choices=[(1, 'Discovered'), (2, 'Assigned rights'), (3, 'Packaged'), (4, 'Delivered'), (5, 'Archived'), (11, 'Assigning rights'), (12, 'Creating package'), (13, 'Delivering'), (14, 'Creating archive'), (15, 'Downloaded object from S3'), (16, 'Discovering'), (17, 'Saved to database'), (18, 'Downloaded object from S3'), (19, 'Duplicate')], default=1),
+        ),
+        migrations.AddIndex(
+            model_name='bag',
+            index=models.Index(fields=['s3_etag'], name='bag_s3_etag_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bag',
+            index=models.Index(fields=['payload_fingerprint'], name='bag_payload_fingerprint_idx'),
+        ),
+    ]
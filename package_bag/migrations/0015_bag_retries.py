@@ -0,0 +1,38 @@
+# Generated by Django 4.2.16 on 2026-10-18 20:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('package_bag', '0014_bag_duplicates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bag',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='bag',
+            name='last_error',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='bag',
+            name='next_attempt',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='bag',
+            name='retry_status',
+            field=models.IntegerField(blank=True, choices=[(1, 'Discovered'), (2, 'Assigned rights'), (3, 'Packaged'), (4, 'Delivered'), (5, 'Archived'), (11, 'Assigning rights'), (12, 'Creating package'), (13, 'Delivering'), (14, 'Creating archive'), (15, 'Downloaded object from S3'), (16, 'Discovering'), (17, 'Saved to database'), (18, 'Downloaded object from S3'), (19, 'Duplicate'), (20, 'Failed')], null=True),
+        ),
+        migrations.AlterField(
+            model_name='bag',
+            name='process_status',
+            field=models.IntegerField(choices=[(1, 'Discovered'), (2, 'Assigned rights'), (3, 'Packaged'), (4, 'Delivered'), (5, 'Archived'), (11, 'Assigning rights'), (12, 'Creating package'), (13, 'Delivering'), (14, 'Creating archive'), (15, 'Downloaded object from S3'), (16, 'Discovering'), (17, 'Saved to database'), (18, 'Downloaded object from S3'), (19, 'Duplicate'), (20, 'Failed')], default=1),
+        ),
+    ]
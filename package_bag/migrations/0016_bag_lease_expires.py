@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 21:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('package_bag', '0015_bag_retries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bag',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
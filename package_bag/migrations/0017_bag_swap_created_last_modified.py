@@ -0,0 +1,36 @@
+# Generated by Django 4.2.16 on 2026-10-18 23:10
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def swap_created_last_modified(apps, schema_editor):
+    """Swaps the values of `created` and `last_modified`.
+
+    `created` was set on every save and `last_modified` only when a bag was
+    created, so each holds the timestamp the other is named for. Both columns
+    are assigned in a single UPDATE, which reads the values from before it.
+    """
+    Bag = apps.get_model("package_bag", "Bag")
+    Bag.objects.update(created=F("last_modified"), last_modified=F("created"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('package_bag', '0016_bag_lease_expires'),
+    ]
+
+    operations = [
+        migrations.RunPython(swap_created_last_modified, swap_created_last_modified),
+        migrations.AlterField(
+            model_name='bag',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.AlterField(
+            model_name='bag',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -17,6 +17,8 @@ class Bag(BasePackage):
     DISCOVERING = 16
     SAVED = 17
     DOWNLOADING = 18
+    DUPLICATE = 19
+    FAILED = 20
     PROCESS_STATUS_CHOICES = (
         (DISCOVERED, "Discovered"),
         (ASSIGNED_RIGHTS, "Assigned rights"),
@@ -30,13 +32,16 @@ class Bag(BasePackage):
         (DOWNLOADED, "Downloaded object from S3"),
         (DISCOVERING, "Discovering"),
         (SAVED, "Saved to database"),
-        (DOWNLOADING, "Downloaded object from S3")
+        (DOWNLOADING, "Downloaded object from S3"),
+        (DUPLICATE, "Duplicate"),
+        (FAILED, "Failed")
     )
     process_status = models.IntegerField(choices=PROCESS_STATUS_CHOICES, default=DISCOVERED)
-    original_bag_name = models.CharField(max_length=255)
+    original_bag_name = models.CharField(max_length=255, unique=True)
     ORIGIN_CHOICES = (
         ('legacy_digital', 'Legacy Digital Processing'),
-        ('digitization', 'Digitization')
+        ('digitization', 'Digitization'),
+        ('av_digitization', 'Audiovisual Digitization')
     )
     origin = models.CharField(
         max_length=20,
@@ -53,8 +58,31 @@ class Bag(BasePackage):
         null=True,
         blank=True)
     rights_data = models.JSONField(null=True, blank=True)
-    created = models.DateTimeField(auto_now=True)
-    last_modified = models.DateTimeField(auto_now_add=True)
+    s3_etag = models.CharField(max_length=255, null=True, blank=True)
+    payload_fingerprint = models.CharField(max_length=64, null=True, blank=True)
+    duplicate_of = models.ForeignKey(
+        "self",
+        on_delete=models.SET_NULL,
+        related_name="duplicates",
+        null=True,
+        blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    next_attempt = models.DateTimeField(null=True, blank=True)
+    retry_status = models.IntegerField(choices=PROCESS_STATUS_CHOICES, null=True, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    last_modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["process_status", "id"], name="bag_process_status_id_idx"),
+            models.Index(fields=["origin", "id"], name="bag_origin_id_idx"),
+            models.Index(fields=["created"], name="bag_created_idx"),
+            models.Index(fields=["last_modified"], name="bag_last_modified_idx"),
+            models.Index(fields=["s3_etag"], name="bag_s3_etag_idx"),
+            models.Index(fields=["payload_fingerprint"], name="bag_payload_fingerprint_idx"),
+        ]
 
 
 class User(AbstractUser):
@@ -0,0 +1,12 @@
+from rest_framework.pagination import CursorPagination
+
+
+class BagCursorPagination(CursorPagination):
+    """Paginates Bags by cursor, newest first.
+
+    Unlike page number pagination, this does not count the whole queryset for
+    every page, and pages stay stable while Bags are being added.
+    """
+    ordering = "-id"
+    page_size_query_param = "page_size"
+    max_page_size = 500
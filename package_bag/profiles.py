@@ -0,0 +1,59 @@
+import json
+from os.path import getmtime, join
+from threading import Lock
+
+import bagit_profile
+
+from zorya import settings
+
+
+class ProfileRegistry(object):
+    """Process-wide cache of BagIt profiles.
+
+    Profiles are configured per bag Origin in `settings.BAGIT_PROFILES`, with
+    a "default" entry used for any other Origin. Each profile file is parsed
+    and validated once, and reloaded only when its modification time changes.
+    """
+
+    def __init__(self):
+        self.profiles = {}
+        self.lock = Lock()
+
+    def get(self, origin):
+        """Returns the profile for an Origin.
+
+        Args:
+            origin (str): the Origin of a bag.
+
+        Returns:
+            profile (bagit_profile.Profile): the parsed profile.
+        """
+        profiles = settings.BAGIT_PROFILES
+        path = join(settings.BASE_DIR, "package_bag", profiles.get(origin, profiles["default"]))
+        modified = getmtime(path)
+        with self.lock:
+            cached = self.profiles.get(path)
+            if not cached or cached[0] != modified:
+                with open(path, "r") as fp:
+                    data = json.load(fp)
+                profile = bagit_profile.Profile(data["BagIt-Profile-Info"]["BagIt-Profile-Identifier"], profile=data)
+                cached = self.profiles[path] = (modified, profile)
+        return cached[1]
+
+    def validate(self, bagit_bag):
+        """Validates a bag against the profile for its Origin.
+
+        Args:
+            bagit_bag (bagit.Bag): the bag to validate.
+
+        Returns:
+            errors (list): profile validation errors, empty if the bag is valid.
+        """
+        origin = bagit_bag.info.get("Origin")
+        profile = self.get(origin if isinstance(origin, str) else None)
+        with self.lock:
+            # Profile keeps the report of its last validation on the instance.
+            return [] if profile.validate(bagit_bag) else profile.report.errors
+
+
+profile_registry = ProfileRegistry()
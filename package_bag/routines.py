@@ -1,23 +1,52 @@
+import hashlib
 import json
+import logging
+import re
 import tarfile
-from os import mkdir, remove, rename
-from os.path import isdir, join
+import time
+from base64 import b64decode, b64encode
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from os import fsync, makedirs, remove, rename, replace
+from os.path import basename, getsize, isdir, isfile, join
+from shutil import rmtree
+from threading import Event, Lock, Thread
 from uuid import uuid4
 
 import bagit
-import bagit_profile
 import boto3
-from asterism.bagit_helpers import validate
-from asterism.file_helpers import make_tarfile
 from botocore.exceptions import ClientError
-from requests import post
-
-from package_bag.helpers import expected_file_name
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from package_bag import json_codec
+from package_bag.clients import head, post, put
+from package_bag.compression import (EXTENSIONS, choose_compression,
+                                     make_tarfile)
+from package_bag.helpers import (FINGERPRINT_FIELDS, HASH_BLOCK_SIZE,
+                                 ETagHasher, HashingReader, bag_size,
+                                 expected_file_name, extract_bag,
+                                 is_compressed, manifest_algorithms,
+                                 payload_fingerprint, precheck_bag,
+                                 validate_bag, write_package)
+from package_bag.metrics import (BAG_PROCESS_SECONDS, BAGS_PROCESSED,
+                                 BYTES_PROCESSED, ROUTINE_RUN_SECONDS,
+                                 ROUTINE_RUNS)
+from package_bag.profiles import profile_registry
 from package_bag.serializers import BagSerializer
 from zorya import settings
 
 from .models import Bag
 
+logger = logging.getLogger(__name__)
+
+# First key of the PostgreSQL advisory locks taken while claiming bags; the second is the routine's in process status
+CLAIM_LOCK_NAMESPACE = 7925
+
 
 class S3ClientMixin(object):
     """Mixin to handle communication with S3."""
@@ -27,27 +56,75 @@ class S3ClientMixin(object):
         s3 = boto3.resource(service_name='s3', region_name=region_name, aws_access_key_id=access_key, aws_secret_access_key=secret_key)
         self.bucket = s3.Bucket(bucket)
 
+    def delete_object_from_s3(self, filename):
+        """Deletes an object from an S3 bucket
+
+        Args:
+            filename (str): filename which should be the S3 object key"""
+        try:
+            self.bucket.delete_objects(Delete={'Objects': [{'Key': filename}]})
+        except ClientError as e:
+            raise Exception("Error connecting to AWS: {}".format(e))
+
 
 class S3ObjectFinder(S3ClientMixin):
 
     def run(self):
         list_to_download = self.list_to_download()
-        for obj in list_to_download:
-            new_bag = Bag.objects.create(
-                original_bag_name=obj,
-                bag_identifier=str(uuid4()),
-                process_status=Bag.SAVED)
-            new_bag.save()
+        originals = self.find_originals(list_to_download.values())
+        bags, duplicates, etags = [], {}, set()
+        for obj, etag in list_to_download.items():
+            if etag in originals or etag in etags:
+                duplicates[obj] = etag
+            else:
+                etags.add(etag)
+                bags.append(Bag(original_bag_name=obj, bag_identifier=str(uuid4()), s3_etag=etag, process_status=Bag.SAVED))
+        Bag.objects.bulk_create(bags, ignore_conflicts=True)
+        if duplicates:
+            originals = self.find_originals(duplicates.values())
+            Bag.objects.bulk_create(
+                [Bag(original_bag_name=obj, bag_identifier=str(uuid4()), s3_etag=etag, duplicate_of_id=originals.get(etag),
+                     process_status=Bag.DUPLICATE if etag in originals else Bag.SAVED) for obj, etag in duplicates.items()],
+                ignore_conflicts=True)
+            # Duplicates are never downloaded, so they are deleted from the bucket here
+            recorded = Bag.objects.filter(original_bag_name__in=list(duplicates), process_status=Bag.DUPLICATE)
+            for filename in recorded.values_list("original_bag_name", flat=True):
+                self.delete_object_from_s3(filename)
         msg = "Saved bags to database." if list_to_download else "No bags in bucket."
-        return msg, list_to_download if list_to_download else []
+        return msg, list(list_to_download)
 
     def list_to_download(self):
         """Gets list of items to download from S3 bucket, and removes items which do no match criteria
 
+        Filenames already saved to the database are looked up in a single query
+        against the unique index on `original_bag_name`. Objects are ordered by
+        the time they were last modified, then by key, so that of several new
+        objects with the same content the one uploaded first is the original
+        and the others are its duplicates. S3 records the time to the second,
+        so of objects uploaded within the same second the one whose key sorts
+        first is the original.
+
+        Returns:
+            Dict of filenames (strings) to S3 ETags (strings)"""
+        bucket_objects = sorted(
+            (bucket_object for bucket_object in self.bucket.objects.all() if expected_file_name(bucket_object.key)),
+            key=lambda bucket_object: (bucket_object.last_modified, bucket_object.key))
+        files_in_bucket = {bucket_object.key: bucket_object.e_tag.strip('"') for bucket_object in bucket_objects}
+        saved = set(Bag.objects.filter(original_bag_name__in=files_in_bucket).values_list("original_bag_name", flat=True))
+        return {filename: etag for filename, etag in files_in_bucket.items() if filename not in saved}
+
+    def find_originals(self, etags):
+        """Finds bags which were uploaded to S3 with the same content as new objects
+
+        An object with the same ETag as one already saved has the same content,
+        so it is saved as a duplicate and never downloaded. Objects uploaded in
+        parts of a different size have different ETags, so some duplicates are
+        only detected once they are discovered.
+
         Returns:
-            List of filenames (strings)"""
-        files_in_bucket = [bucket_object.key for bucket_object in self.bucket.objects.all()]
-        return [filename for filename in files_in_bucket if expected_file_name(filename) and not Bag.objects.filter(original_bag_name__contains=filename).exists()]
+            Dict of ETags (strings) to the primary key of the first bag with that ETag"""
+        originals = Bag.objects.filter(s3_etag__in=set(etags)).exclude(process_status=Bag.DUPLICATE).order_by("-pk")
+        return dict(originals.values_list("s3_etag", "pk"))
 
 
 class BaseRoutine(object):
@@ -56,6 +133,24 @@ class BaseRoutine(object):
     Returns:
         msg (str): human-readable representation of the routine outcome
 
+    Bags are claimed with row-level locks, so several workers can run the same
+    routine concurrently. The number of bags a routine may have in process at
+    once is limited by `settings.ROUTINE_CONCURRENCY`. On PostgreSQL, claims
+    by workers running the same routine are serialized by an advisory lock, so
+    the limit holds however many workers there are; on other databases it is
+    best-effort.
+
+    A bag which fails is returned to the start process status, but is not
+    claimed again until a delay has passed, which doubles with each failure.
+    After `settings.MAX_ATTEMPTS` failures it is moved to the Failed status,
+    so one broken bag cannot hold up the bags behind it.
+
+    Claimed bags are leased for `settings.LEASE_DURATION` seconds, and the
+    lease is renewed while they are processed. Bags whose lease has expired,
+    because the worker processing them died, are reclaimed the next time the
+    routine runs: `clean_up` removes any partial output, and the bag is
+    treated as having failed.
+
     Subclasses should implement a `process_bag` method which executes logic on
     one bag. They should also set the following attributes:
         start_process_status (int): a Bag process status which determines the starting
@@ -66,29 +161,269 @@ class BaseRoutine(object):
             successfully.
         idle_message (str): a message indicating that there were no objects for
             the routine to act on.
+    Subclasses may also set `batch_size` to claim and process several bags in
+    one run, and `requests_in_flight` to process up to that many bags in a
+    batch concurrently in a pool of threads. A `process_bag` method may take a bag
+    out of the pipeline by setting its process status, for example to
+    `Bag.DUPLICATE`, in which case it is not moved to the end process status.
     """
+    batch_size = 1
+    requests_in_flight = 1
+    # Held while leases are renewed and while bags are saved under a lease, so a bag's lease never changes as it is saved
+    lease_lock = Lock()
 
     def run(self):
-        if not Bag.objects.filter(process_status=self.in_process_status).exists():
-            bag = Bag.objects.filter(process_status=self.start_process_status).first()
-            if bag:
-                bag.process_status = self.in_process_status
-                bag.save()
-                try:
-                    self.process_bag(bag)
-                except Exception:
-                    bag.process_status = self.start_process_status
-                    bag.save()
-                    raise
+        routine = self.__class__.__name__
+        start = time.monotonic()
+        outcome = "failure"
+        try:
+            self.reclaim_bags()
+            capacity = self.concurrency - Bag.objects.filter(process_status=self.in_process_status).count()
+            if capacity <= 0:
+                outcome = "busy"
+                return "Service currently running", []
+            bags = self.claim_bags(min(self.batch_size, capacity))
+            with self.heartbeat(bags):
+                if self.requests_in_flight > 1 and len(bags) > 1:
+                    self.process_bags_concurrently(bags)
+                else:
+                    self.process_bags(bags)
+            outcome = "success" if bags else "idle"
+            msg = self.success_message if bags else self.idle_message
+            return msg, [bag.bag_identifier for bag in bags]
+        finally:
+            ROUTINE_RUNS.inc(routine=routine, outcome=outcome)
+            ROUTINE_RUN_SECONDS.observe(time.monotonic() - start, routine=routine)
+
+    def measure_process_bag(self, bag):
+        """Runs `process_bag`, recording how long it took, the size of the bag and the outcome.
+
+        The size is read from the bag's archive or its Payload-Oxum, so no bag
+        is walked just to measure it."""
+        routine = self.__class__.__name__
+        size = bag_size(bag.bag_path)
+        start = time.monotonic()
+        try:
+            self.process_bag(bag)
+        except Exception:
+            BAGS_PROCESSED.inc(routine=routine, outcome="failure")
+            raise
+        finally:
+            BAG_PROCESS_SECONDS.observe(time.monotonic() - start, routine=routine)
+        BAGS_PROCESSED.inc(routine=routine, outcome="success")
+        BYTES_PROCESSED.inc(size or bag_size(bag.bag_path), routine=routine)
+
+    def process_bags(self, bags):
+        """Processes bags one after another, stopping at the first failure."""
+        for index, bag in enumerate(bags):
+            try:
+                self.measure_process_bag(bag)
+            except Exception as e:
+                self.fail_bag(bag, e)
+                for unprocessed in bags[index + 1:]:
+                    self.release_bag(unprocessed)
+                raise
+            self.finish_bag(bag)
+
+    def process_bags_concurrently(self, bags):
+        """Processes bags concurrently, with up to `requests_in_flight` in process at once.
+
+        Bags which were processed successfully are moved to the end process
+        status and bags which failed are handled by `fail_bag`.
+        If any bag failed, the first exception is raised once all bags have been
+        processed.
+        """
+        with ThreadPoolExecutor(max_workers=self.requests_in_flight) as executor:
+            futures = [executor.submit(self.measure_process_bag, bag) for bag in bags]
+        results = [future.exception() for future in futures]
+        for bag, result in zip(bags, results):
+            if isinstance(result, Exception):
+                self.fail_bag(bag, result)
+            else:
+                self.finish_bag(bag)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+    def finish_bag(self, bag):
+        """Moves a processed bag to the end process status, unless `process_bag` moved it elsewhere."""
+        with self.lease_lock:
+            lease_expires = bag.lease_expires
+            if bag.process_status == self.in_process_status:
                 bag.process_status = self.end_process_status
-                bag.save()
-                msg = self.success_message
+            bag.attempts = 0
+            bag.last_error = None
+            bag.next_attempt = None
+            bag.lease_expires = None
+            return self.save_leased_bag(bag, lease_expires)
+
+    def fail_bag(self, bag, exception):
+        """Records a failure to process a bag, and either schedules it to be retried or moves it to the Failed status.
+
+        Bags are retried after `settings.RETRY_BACKOFF` seconds, doubled for
+        each earlier failure up to `settings.RETRY_BACKOFF_MAX`. Once a bag has
+        failed `settings.MAX_ATTEMPTS` times, the status it should be retried
+        from is kept in `retry_status` until it is requeued."""
+        with self.lease_lock:
+            lease_expires = bag.lease_expires
+            bag.attempts += 1
+            bag.last_error = "{}: {}".format(exception.__class__.__name__, exception)
+            bag.lease_expires = None
+            if bag.attempts >= settings.MAX_ATTEMPTS:
+                bag.process_status = Bag.FAILED
+                bag.retry_status = self.start_process_status
+                bag.next_attempt = None
             else:
-                msg = self.idle_message
-        else:
-            msg = "Service currently running"
-            bag = None
-        return msg, [bag.bag_identifier] if bag else []
+                bag.process_status = self.start_process_status
+                delay = min(settings.RETRY_BACKOFF * 2 ** (bag.attempts - 1), settings.RETRY_BACKOFF_MAX)
+                bag.next_attempt = timezone.now() + timedelta(seconds=delay)
+            return self.save_leased_bag(bag, lease_expires)
+
+    def release_bag(self, bag):
+        """Returns a claimed bag which was not processed to the start process status, to be claimed again straight away."""
+        with self.lease_lock:
+            lease_expires = bag.lease_expires
+            bag.process_status = self.start_process_status
+            bag.lease_expires = None
+            return self.save_leased_bag(bag, lease_expires)
+
+    def save_leased_bag(self, bag, lease_expires):
+        """Saves a bag, provided it is still in process under the given lease
+
+        A bag whose lease was lost, because it expired and the bag was
+        reclaimed, may already be being processed again, so it is left as it is.
+
+        Returns:
+            saved (bool): whether the bag was saved."""
+        values = {field.attname: field.pre_save(bag, False) for field in Bag._meta.concrete_fields if not field.primary_key}
+        saved = Bag.objects.filter(pk=bag.pk, process_status=self.in_process_status, lease_expires=lease_expires).update(**values)
+        if not saved:
+            logger.warning("%s lost the lease on bag %s before saving it.", self.__class__.__name__, bag.bag_identifier)
+        return bool(saved)
+
+    @property
+    def concurrency(self):
+        """Maximum number of bags this routine may have in process at once."""
+        limits = settings.ROUTINE_CONCURRENCY
+        return limits.get(self.__class__.__name__, limits.get("default", 1))
+
+    def claim_bags(self, count=1):
+        """Atomically claims the next bags waiting for this routine.
+
+        Rows locked by other workers are skipped, so workers running the same
+        routine concurrently never claim the same bag. Bags waiting to be
+        retried after a failure are skipped until their next attempt is due.
+        No more bags are claimed than would take the routine past its
+        concurrency limit, counted while holding the routine's claim lock.
+
+        Args:
+            count (int): maximum number of bags to claim.
+
+        Returns:
+            bags (list): the claimed bags, empty if no bags are waiting.
+        """
+        with transaction.atomic():
+            self.lock_claims()
+            count = min(count, self.concurrency - Bag.objects.filter(process_status=self.in_process_status).count())
+            if count <= 0:
+                return []
+            bags = list(Bag.objects.select_for_update(skip_locked=True).filter(
+                Q(next_attempt__isnull=True) | Q(next_attempt__lte=timezone.now()),
+                process_status=self.start_process_status).order_by("pk")[:count])
+            lease_expires = timezone.now() + timedelta(seconds=settings.LEASE_DURATION)
+            for bag in bags:
+                bag.process_status = self.in_process_status
+                bag.lease_expires = lease_expires
+                bag.save()
+        return bags
+
+    def lock_claims(self):
+        """Takes a lock, held until the end of the current transaction, which serializes claims for this routine
+
+        Only PostgreSQL has advisory locks, so on other databases this does nothing."""
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", [CLAIM_LOCK_NAMESPACE, self.in_process_status])
+
+    def renew_lease(self, bags):
+        """Extends the lease on bags which are still in process under the lease this worker holds"""
+        lease_expires = timezone.now() + timedelta(seconds=settings.LEASE_DURATION)
+        with self.lease_lock:
+            for bag in bags:
+                if bag.lease_expires and Bag.objects.filter(
+                        pk=bag.pk, process_status=self.in_process_status, lease_expires=bag.lease_expires).update(lease_expires=lease_expires):
+                    bag.lease_expires = lease_expires
+
+    @contextmanager
+    def heartbeat(self, bags):
+        """Renews the lease on bags from a background thread while they are processed
+
+        A failure to renew, for example because the database was briefly
+        unreachable, is logged and renewal is tried again on the next beat."""
+        if not bags:
+            yield
+            return
+        stop = Event()
+
+        def renew():
+            try:
+                while not stop.wait(settings.LEASE_DURATION / 3):
+                    try:
+                        self.renew_lease(bags)
+                    except Exception:
+                        logger.exception("%s could not renew the lease on bags in process.", self.__class__.__name__)
+                        connection.close()
+            finally:
+                connection.close()
+
+        thread = Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def reclaim_bags(self):
+        """Reclaims bags left in process by a worker which stopped before finishing them
+
+        Bags in this routine's in process status whose lease has expired, or
+        which have no lease, are cleaned up and handled as failures, so they
+        are retried and a bag which keeps killing workers ends up Failed.
+
+        The bags are first leased to this worker, so no other worker claims or
+        reclaims them while they are cleaned up, which happens outside the
+        transaction since it may touch the filesystem and S3. A bag which
+        cannot be cleaned up is left for its new lease to expire, so it is
+        reclaimed again later.
+
+        Returns:
+            bags (list): the reclaimed bags."""
+        lease_expires = timezone.now() + timedelta(seconds=settings.LEASE_DURATION)
+        with transaction.atomic():
+            bags = list(Bag.objects.select_for_update(skip_locked=True).filter(
+                Q(lease_expires__isnull=True) | Q(lease_expires__lt=timezone.now()),
+                process_status=self.in_process_status))
+            Bag.objects.filter(pk__in=[bag.pk for bag in bags]).update(lease_expires=lease_expires)
+        reclaimed = []
+        for bag in bags:
+            bag.lease_expires = lease_expires
+            try:
+                self.clean_up(bag)
+            except Exception:
+                logger.exception("%s could not clean up bag %s.", self.__class__.__name__, bag.bag_identifier)
+                continue
+            if self.fail_bag(bag, Exception("Lease expired before {} finished processing the bag.".format(self.__class__.__name__))):
+                BAGS_PROCESSED.inc(routine=self.__class__.__name__, outcome="reclaimed")
+                reclaimed.append(bag)
+        return reclaimed
+
+    def clean_up(self, bag):
+        """Removes partial output left by a worker which stopped while processing a bag
+
+        Subclasses whose `process_bag` writes files which would get in the way
+        of processing the bag again should override this."""
+        pass
 
     def process_bag(self, bag):
         raise NotImplementedError("You must implement a `process_bag` method")
@@ -104,42 +439,193 @@ class S3ObjectDownloader(BaseRoutine, S3ClientMixin):
     def __init__(self):
         super().__init__()
         self.src_dir = settings.SRC_DIR
+        self.tmp_dir = settings.TMP_DIR
 
     def process_bag(self, bag):
-        downloaded_file = self.download_object_from_s3(bag.original_bag_name)
+        if settings.S3_STREAM_EXTRACT:
+            bag.bag_path = self.extract_object_from_s3(bag.original_bag_name, bag.bag_identifier)
+        else:
+            bag.bag_path = self.download_object_from_s3(bag.original_bag_name)
         self.delete_object_from_s3(bag.original_bag_name)
-        bag.bag_path = downloaded_file
 
     def download_object_from_s3(self, filename):
         """Downloads an object from S3 to the source directory
 
+        The object is fetched in byte ranges by a pool of threads. Completed
+        ranges are recorded in a journal next to the partially downloaded file,
+        so a download which is interrupted resumes where it left off. Once all
+        ranges are fetched the file is verified against the checksums S3 holds
+        for the object.
+
         Args:
             filename (str): filename which should be the S3 object key as well as the filename to download to
 
         Returns:
             downloaded_file (str): full path to downloaded file"""
         downloaded_file = join(self.src_dir, filename)
+        partial_file = "{}.part".format(downloaded_file)
+        client = self.bucket.meta.client
         try:
-            self.bucket.download_file(filename, downloaded_file)
-            return downloaded_file
+            head = client.head_object(Bucket=self.bucket.name, Key=filename, ChecksumMode="ENABLED")
+            self.download_ranges(filename, partial_file, head)
+            self.verify_checksums(filename, partial_file, head)
         except ClientError as e:
-            if e.response['Error']['Code'] == "404":
+            if e.response['Error']['Code'] in ["404", "NoSuchKey"]:
                 raise Exception("The object does not exist.")
             else:
                 raise Exception("Error connecting to AWS: {}".format(e))
+        rename(partial_file, downloaded_file)
+        remove("{}.json".format(partial_file))
+        return downloaded_file
 
-    def delete_object_from_s3(self, filename):
-        """Deletes an object from an S3 bucket
+    def download_ranges(self, filename, partial_file, head):
+        """Downloads the byte ranges of an object which have not yet been fetched.
+
+        Args:
+            filename (str): S3 object key
+            partial_file (str): full path of the file to download to
+            head (dict): response to a HEAD request for the object
+        """
+        client = self.bucket.meta.client
+        size = head["ContentLength"]
+        part_size = settings.S3_DOWNLOAD_PART_SIZE
+        journal_file = "{}.json".format(partial_file)
+        journal = {"etag": head["ETag"], "size": size, "part_size": part_size, "completed": []}
+        if isfile(journal_file) and isfile(partial_file):
+            with open(journal_file, "r") as f:
+                saved = json.load(f)
+            if all(saved.get(key) == journal[key] for key in ["etag", "size", "part_size"]):
+                journal = saved
+        if not journal["completed"]:
+            with open(partial_file, "wb") as f:
+                f.truncate(size)
+        completed = set(journal["completed"])
+        lock = Lock()
+
+        def save_journal():
+            with open("{}.tmp".format(journal_file), "w") as f:
+                json.dump(journal, f)
+            replace("{}.tmp".format(journal_file), journal_file)
+
+        def download_range(start):
+            end = min(start + part_size, size) - 1
+            response = client.get_object(
+                Bucket=self.bucket.name, Key=filename, Range="bytes={}-{}".format(start, end), IfMatch=head["ETag"])
+            with open(partial_file, "r+b") as f:
+                f.seek(start)
+                for chunk in response["Body"].iter_chunks(chunk_size=1024 * 1024):
+                    f.write(chunk)
+                f.flush()
+                fsync(f.fileno())
+            with lock:
+                completed.add(start)
+                journal["completed"] = sorted(completed)
+                save_journal()
+
+        save_journal()
+        pending = [start for start in range(0, size, part_size) if start not in completed]
+        with ThreadPoolExecutor(max_workers=settings.S3_DOWNLOAD_THREADS) as executor:
+            for future in [executor.submit(download_range, start) for start in pending]:
+                future.result()
+
+    def checksum_hashers(self, filename, head):
+        """Returns hashers for the checksums S3 holds for an object.
+
+        A full-object SHA-256 checksum is used when the object has one. The
+        ETag is used unless the object is encrypted with KMS, in which case it
+        is not derived from the object content.
+
+        Returns:
+            hashers (dict): hashers keyed by the hexdigest they are expected to produce.
+        """
+        hashers = {}
+        sha256 = head.get("ChecksumSHA256")
+        if sha256 and "-" not in sha256:
+            hashers[b64decode(sha256).hex()] = hashlib.sha256()
+        etag = head["ETag"].strip('"')
+        if head.get("ServerSideEncryption") != "aws:kms" and re.match(r"^[0-9a-f]{32}(-\d+)?$", etag):
+            part_size = None
+            if "-" in etag:
+                part_size = self.bucket.meta.client.head_object(
+                    Bucket=self.bucket.name, Key=filename, PartNumber=1)["ContentLength"]
+            hashers[etag] = ETagHasher(part_size)
+        return hashers
+
+    def verify_checksums(self, filename, partial_file, head):
+        """Verifies a downloaded file against the checksums S3 holds for the object.
+
+        A file which fails verification is removed along with its journal, so
+        that the next attempt starts from scratch."""
+        hashers = self.checksum_hashers(filename, head)
+        with open(partial_file, "rb") as f:
+            while True:
+                block = f.read(1024 * 1024)
+                if not block:
+                    break
+                for hasher in hashers.values():
+                    hasher.update(block)
+        for expected, hasher in hashers.items():
+            if hasher.hexdigest() != expected:
+                remove(partial_file)
+                remove("{}.json".format(partial_file))
+                raise Exception("Checksum mismatch for {}: expected {} but got {}".format(filename, expected, hasher.hexdigest()))
+
+    def extract_object_from_s3(self, filename, bag_identifier):
+        """Streams an object from S3 directly into an extracted bag directory
+
+        The tarball is never written to disk: the object body is read through a
+        tar reader and extracted to a directory named with the bag identifier in
+        the temporary directory. The stream is verified against the checksums S3
+        holds for the object as it is read.
 
         Args:
             filename (str): filename which should be the S3 object key
+            bag_identifier (str): identifier of the bag, used as the directory name
 
         Returns:
-            downloaded_file (str): full path to downloaded file"""
+            bag_path (str): full path to the extracted bag"""
+        bag_path = join(self.tmp_dir, bag_identifier)
+        client = self.bucket.meta.client
         try:
-            self.bucket.delete_objects(Delete={'Objects': [{'Key': filename}]})
+            head = client.head_object(Bucket=self.bucket.name, Key=filename, ChecksumMode="ENABLED")
+            hashers = self.checksum_hashers(filename, head)
+            body = client.get_object(Bucket=self.bucket.name, Key=filename, IfMatch=head["ETag"])["Body"]
+            stream = HashingReader(body, hashers.values())
+            with tarfile.open(fileobj=stream, mode="r|*", bufsize=1024 * 1024) as tf:
+                extract_bag(tf, bag_path)
+            while stream.read(1024 * 1024):
+                pass
+            for expected, hasher in hashers.items():
+                if hasher.hexdigest() != expected:
+                    raise Exception("Checksum mismatch for {}: expected {} but got {}".format(filename, expected, hasher.hexdigest()))
         except ClientError as e:
-            raise Exception("Error connecting to AWS: {}".format(e))
+            rmtree(bag_path, ignore_errors=True)
+            if e.response['Error']['Code'] in ["404", "NoSuchKey"]:
+                raise Exception("The object does not exist.")
+            else:
+                raise Exception("Error connecting to AWS: {}".format(e))
+        except Exception:
+            rmtree(bag_path, ignore_errors=True)
+            raise
+        return bag_path
+
+    def clean_up(self, bag):
+        """Removes a partially extracted bag, as long as the object is still in S3 to extract it from again
+
+        Partially downloaded objects are kept, so their download resumes."""
+        bag_path = join(self.tmp_dir, bag.bag_identifier)
+        if isdir(bag_path) and self.object_exists(bag.original_bag_name):
+            rmtree(bag_path)
+
+    def object_exists(self, filename):
+        """Returns whether an object is in the S3 bucket"""
+        try:
+            self.bucket.Object(filename).load()
+        except ClientError as e:
+            if e.response['Error']['Code'] in ["404", "NoSuchKey"]:
+                return False
+            raise
+        return True
 
 
 class BagDiscoverer(BaseRoutine):
@@ -160,39 +646,87 @@ class BagDiscoverer(BaseRoutine):
                 raise Exception("Directory does not exist", dir)
 
     def process_bag(self, bag):
-        bag.bag_path = self.unpack_rename(bag)
-        bag.save()
-        validate(bag.bag_path)
-        bag_data = self.validate_metadata(bag)
-        for key in ["Origin", "Rights-ID", "Start-Date", "End-Date"]:
+        checksums = None
+        if not isdir(bag.bag_path):
+            bag.bag_path, checksums = self.unpack_rename(bag)
+        Bag.objects.filter(pk=bag.pk, process_status=self.in_process_status).update(bag_path=bag.bag_path)
+        bagit_bag = validate_bag(bag.bag_path, settings.BAG_VALIDATION_WORKERS, checksums)
+        bag_data = self.validate_metadata(bagit_bag)
+        for key in FINGERPRINT_FIELDS:
             setattr(bag, key.lower().replace("-", "_"), bag_data.get(key))
+        bag.payload_fingerprint = payload_fingerprint(bagit_bag)
+        original = self.find_original(bag)
+        if original:
+            rmtree(bag.bag_path)
+            bag.duplicate_of = original
+            bag.process_status = Bag.DUPLICATE
+
+    def clean_up(self, bag):
+        """Removes a partially unpacked bag, or records the path of a bag which was unpacked but not saved"""
+        bag_path = join(self.tmp_dir, bag.bag_identifier)
+        if isdir(bag_path) and bag.bag_path != bag_path:
+            if isfile(bag.bag_path):
+                rmtree(bag_path)
+            else:
+                bag.bag_path = bag_path
+
+    def find_original(self, bag):
+        """Finds an earlier bag with the same payload and metadata, which has not itself been found to be a duplicate
+
+        Returns:
+            original (Bag): the first such bag, or None"""
+        return Bag.objects.filter(payload_fingerprint=bag.payload_fingerprint).exclude(
+            pk=bag.pk).exclude(process_status=Bag.DUPLICATE).order_by("pk").first()
 
     def unpack_rename(self, bag):
-        """Unpacks tarfile to a new directory with the name of the bag identifier (a UUID)"""
-        tf = tarfile.open(bag.bag_path, 'r')
-        tf.extractall(self.tmp_dir)
-        original_bag_name = tf.getnames()[0].split('/')[0]
-        tf.close()
-        rename(join(self.tmp_dir, original_bag_name),
-               join(self.tmp_dir, bag.bag_identifier))
+        """Unpacks tarfile to a new directory with the name of the bag identifier (a UUID)
+
+        The structure and metadata of an uncompressed bag are checked from the
+        tar headers and tag files before anything is extracted, and its files
+        are hashed with the algorithms used in its manifests as they are
+        extracted, so fixity can be verified without reading them again.
+
+        Reading the headers of a compressed bag first would decompress it in
+        full, and extracting it would then decompress it again from the start.
+        A compressed bag is instead extracted in a single pass without a
+        precheck, and its files are hashed with bagit's default algorithms;
+        `validate_bag` hashes them again only if its manifests use others.
+
+        Returns:
+            bag_path (str): full path to the unpacked bag
+            checksums (dict): checksums of the extracted files"""
+        bag_path = join(self.tmp_dir, bag.bag_identifier)
+        with tarfile.open(bag.bag_path, 'r') as tf:
+            if is_compressed(tf):
+                algorithms = sorted(bagit.DEFAULT_CHECKSUMS)
+            else:
+                precheck_bag(tf, profile_registry)
+                algorithms = manifest_algorithms(tf.getnames())
+            checksums = extract_bag(tf, bag_path, algorithms)
         remove(bag.bag_path)
-        return join(self.tmp_dir, bag.bag_identifier)
-
-    def validate_metadata(self, bag):
-        """Validates the bag-info.txt file against the bagit profile"""
-        new_bag = bagit.Bag(bag.bag_path)
-        bagit_profile_json = "zorya_bagit_profile.json"
-        with open(join(settings.BASE_DIR, "package_bag", bagit_profile_json), "r") as fp:
-            data = json.load(fp)
-        profile = bagit_profile.Profile(bagit_profile_json, profile=data)
-        if not profile.validate(new_bag):
-            raise TypeError(profile.report.errors)
+        return bag_path, checksums
+
+    def validate_metadata(self, bagit_bag):
+        """Validates the bag-info.txt file against the bagit profile for the bag's Origin
+
+        Args:
+            bagit_bag (bagit.Bag): the bag, as already loaded for validation
+
+        Returns:
+            info (dict): the contents of bag-info.txt"""
+        errors = profile_registry.validate(bagit_bag)
+        if errors:
+            raise TypeError(errors)
         else:
-            return new_bag.info
+            return bagit_bag.info
 
 
 class RightsAssigner(BaseRoutine):
-    """Send rights IDs to external service and receive JSON in return"""
+    """Send rights IDs to external service and receive JSON in return
+
+    Bags are processed in batches, and responses are cached by rights IDs and
+    dates, so bags in a batch which share them cause a single request, even
+    when several requests are in flight at once."""
 
     start_process_status = Bag.DISCOVERED
     in_process_status = Bag.ASSIGNING_RIGHTS
@@ -200,23 +734,49 @@ class RightsAssigner(BaseRoutine):
     success_message = "Rights assigned."
     idle_message = "No bags waiting for rights assignment."
 
+    def __init__(self):
+        self.query_locks = defaultdict(Lock)
+        self.query_locks_lock = Lock()
+
+    @property
+    def batch_size(self):
+        return settings.RIGHTS_BATCH_SIZE
+
+    @property
+    def requests_in_flight(self):
+        return settings.REQUESTS_IN_FLIGHT
+
     def process_bag(self, bag):
         bag.rights_data = self.retrieve_rights(bag)
 
     def retrieve_rights(self, bag):
         """Sends POST request to rights statement service, receives JSON in return"""
-        url = settings.RIGHTS_URL
-        resp = post(
-            url,
-            json={"identifiers": bag.rights_id, "start_date": bag.start_date, "end_date": bag.end_date}
-        )
-        if resp.status_code != 200:
-            raise Exception("Error sending request to {}: {} {}".format(url, resp.status_code, resp.reason))
-        return resp.json()['rights_statements']
+        query = {"identifiers": bag.rights_id, "start_date": bag.start_date, "end_date": bag.end_date}
+        cache_key = "rights:{}".format(hashlib.sha256(json.dumps(query, sort_keys=True).encode()).hexdigest())
+        with self.query_locks_lock:
+            query_lock = self.query_locks[cache_key]
+        with query_lock:
+            rights_statements = cache.get(cache_key)
+            if rights_statements is None:
+                url = settings.RIGHTS_URL
+                # Rights are looked up with a POST, but the lookup changes nothing, so it is retried like a GET
+                resp = post(url, json=query, idempotent=True)
+                if resp.status_code != 200:
+                    raise Exception("Error sending request to {}: {} {}".format(url, resp.status_code, resp.reason))
+                rights_statements = json_codec.loads(resp.content)['rights_statements']
+                cache.set(cache_key, rights_statements, settings.RIGHTS_CACHE_TIMEOUT)
+        return rights_statements
 
 
 class PackageMaker(BaseRoutine):
-    """Create JSON according to Ursa Major schema and package with bag"""
+    """Create JSON according to Ursa Major schema and package with bag
+
+    By default the JSON and the compressed bag are written to a package
+    directory, which PackageArchiver then archives as `<id>.tar.gz`. If
+    `settings.PACKAGE_FORMAT` is "tar", they are instead written straight into
+    an uncompressed `<id>.tar` package in a single pass. How hard the bag is
+    compressed depends on how compressible its payload is, and is recorded in
+    the JSON."""
 
     start_process_status = Bag.ASSIGNED_RIGHTS
     in_process_status = Bag.PACKAGING
@@ -226,20 +786,50 @@ class PackageMaker(BaseRoutine):
 
     def process_bag(self, bag):
         package_root = join(settings.DEST_DIR, bag.bag_identifier)
-        bag_tar_filename = "{}.tar.gz".format(bag.bag_identifier)
-        self.serialize_json(bag, package_root)
-        make_tarfile(bag.bag_path, join(package_root, bag_tar_filename), remove_src=True)
-
-    def serialize_json(self, bag, package_root):
+        compression = choose_compression(bag.bag_path, settings.PACKAGE_COMPRESSION)
+        if settings.PACKAGE_FORMAT == "tar":
+            package_path = "{}.tar".format(package_root)
+            part_path = "{}.part".format(package_path)
+            write_package(
+                part_path, bag.bag_identifier, bag.bag_path, self.package_data(bag, compression),
+                compression["format"], compression["level"], settings.COMPRESSION_WORKERS, settings.JSON_PRETTY_PRINT)
+            rename(part_path, package_path)
+            rmtree(bag.bag_path)
+        else:
+            self.serialize_json(bag, package_root, compression)
+            bag_tar_filename = "{}.tar.{}".format(bag.bag_identifier, EXTENSIONS[compression["format"]])
+            make_tarfile(
+                bag.bag_path, join(package_root, bag_tar_filename), compression["format"], compression["level"],
+                settings.COMPRESSION_WORKERS, remove_src=True)
+
+    def clean_up(self, bag):
+        """Removes a partially written package"""
+        package_root = join(settings.DEST_DIR, bag.bag_identifier)
+        part_path = "{}.tar.part".format(package_root)
+        if isfile(part_path):
+            remove(part_path)
+        if isdir(package_root) and bag.bag_path and isdir(bag.bag_path):
+            rmtree(package_root)
+
+    def package_data(self, bag, compression=None):
+        """Returns data according to Ursa Major schema, with the compression used for the bag if known"""
+        bag_data = BagSerializer(bag).data
+        if compression:
+            bag_data["compression"] = compression
+        return bag_data
+
+    def serialize_json(self, bag, package_root, compression=None):
         """Serialize JSON to file"""
-        bag_json = BagSerializer(bag).data
-        mkdir(package_root)
-        with open("{}.json".format(join(package_root, bag.bag_identifier)), "w",) as f:
-            json.dump(bag_json, f, indent=4, sort_keys=True, default=str)
+        makedirs(package_root, exist_ok=True)
+        with open("{}.json".format(join(package_root, bag.bag_identifier)), "wb") as f:
+            json_codec.dump(self.package_data(bag, compression), f, settings.JSON_PRETTY_PRINT)
 
 
 class PackageArchiver(BaseRoutine):
-    """Create TAR of package"""
+    """Create TAR of package
+
+    Package directories are archived as `<id>.tar.gz`. Packages written as
+    `<id>.tar` by PackageMaker are already archived, so are left alone."""
 
     start_process_status = Bag.PACKAGED
     in_process_status = Bag.ARCHIVING
@@ -249,8 +839,12 @@ class PackageArchiver(BaseRoutine):
 
     def process_bag(self, bag):
         package_root = join(settings.DEST_DIR, bag.bag_identifier)
-        package_path = "{}.tar.gz".format(package_root)
-        make_tarfile(package_root, package_path, remove_src=True)
+        if isdir(package_root):
+            package_path = "{}.tar.gz".format(package_root)
+            compression = choose_compression(package_root)
+            make_tarfile(package_root, package_path, level=compression["level"], workers=settings.COMPRESSION_WORKERS, remove_src=True)
+        elif not isfile("{}.tar".format(package_root)):
+            raise Exception("Package for {} does not exist.".format(bag.bag_identifier))
 
 
 class PackageDeliverer(BaseRoutine):
@@ -262,20 +856,81 @@ class PackageDeliverer(BaseRoutine):
     success_message = "Package delivered."
     idle_message = "No packages to deliver."
 
+    @property
+    def batch_size(self):
+        return settings.DELIVERY_BATCH_SIZE
+
+    @property
+    def requests_in_flight(self):
+        return settings.REQUESTS_IN_FLIGHT
+
     def process_bag(self, bag):
         dest_dir = settings.DEST_DIR
-        self.deliver_data(bag, dest_dir, settings.DELIVERY_URL)
+        package_url = None
+        if settings.DELIVERY_UPLOAD_URL:
+            package_url = self.upload_package(bag, dest_dir, settings.DELIVERY_UPLOAD_URL)
+        self.deliver_data(bag, dest_dir, settings.DELIVERY_URL, package_url)
+
+    def package_path(self, bag, dest_dir):
+        """Returns the path of a bag's package archive"""
+        package_path = "{}.tar".format(join(dest_dir, bag.bag_identifier))
+        return package_path if isfile(package_path) else "{}.gz".format(package_path)
+
+    def upload_package(self, bag, dest_dir, upload_url):
+        """Uploads a package archive in chunks.
 
-    def deliver_data(self, bag, dest_dir, url):
+        The service is asked how much of the archive it already has, so an
+        interrupted upload resumes where it stopped. Only one chunk is held in
+        memory at a time. The archive is hashed as it is read, and the last
+        chunk carries a SHA-256 Digest header covering the whole archive.
+
+        Returns:
+            url (str): the URL the package was uploaded to.
+        """
+        package_path = self.package_path(bag, dest_dir)
+        url = "{}{}".format(upload_url, basename(package_path))
+        size = getsize(package_path)
+        resp = head(url)
+        if resp.status_code == 404:
+            offset = 0
+        else:
+            resp.raise_for_status()
+            offset = int(resp.headers.get("Upload-Offset", 0))
+            if offset > size:
+                raise Exception("Delivery service has more of {} than exists.".format(basename(package_path)))
+        hasher = hashlib.sha256()
+        with open(package_path, "rb") as f:
+            remaining = offset
+            while remaining:
+                block = f.read(min(HASH_BLOCK_SIZE, remaining))
+                hasher.update(block)
+                remaining -= len(block)
+            while offset < size:
+                chunk = f.read(settings.DELIVERY_UPLOAD_CHUNK_SIZE)
+                hasher.update(chunk)
+                end = offset + len(chunk)
+                headers = {
+                    "Content-Type": "application/octet-stream",
+                    "Content-Range": "bytes {}-{}/{}".format(offset, end - 1, size)}
+                if end == size:
+                    headers["Digest"] = "sha-256={}".format(b64encode(hasher.digest()).decode())
+                put(url, data=chunk, headers=headers).raise_for_status()
+                offset = end
+        return url
+
+    def deliver_data(self, bag, dest_dir, url, package_url=None):
         """Send data to Ursa Major"""
         bag_data = join(
             dest_dir, bag.bag_identifier, "{}.json".format(bag.bag_identifier))
+        data = {
+            "data": bag_data,
+            "origin": bag.origin,
+            "bag_identifier": bag.bag_identifier}
+        if package_url:
+            data["package_url"] = package_url
         r = post(
             url,
-            json={
-                "data": bag_data,
-                "origin": bag.origin,
-                "bag_identifier": bag.bag_identifier},
+            data=json_codec.dumps(data),
             headers={
                 "Content-Type": "application/json"},
         )
@@ -12,3 +12,14 @@ class BagSerializer(serializers.ModelSerializer):
     class Meta:
         model = Bag
         fields = ("identifier", "origin", "rights_statements")
+
+
+class BagListSerializer(serializers.ModelSerializer):
+    """Compact serializer for lists of Bags, which leaves out rights statements"""
+
+    identifier = serializers.CharField(source="bag_identifier")
+
+    class Meta:
+        model = Bag
+        fields = ("id", "identifier", "original_bag_name", "origin", "process_status", "duplicate_of", "attempts", "last_error", "next_attempt",
+                  "created", "last_modified")
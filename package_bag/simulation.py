@@ -0,0 +1,181 @@
+import json
+import logging
+import math
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+from package_bag.benchmarks import ROUTINES, sandbox, upload_bag
+
+from .models import Bag
+
+logger = logging.getLogger(__name__)
+
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    """Answers POST requests after a delay, failing a proportion of them."""
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        service = self.server
+        time.sleep(max(0, random.gauss(service.latency, service.latency / 4)))
+        failed = random.random() < service.error_rate
+        with service.lock:
+            service.requests += 1
+            service.errors += failed
+        status, body = (503, {"detail": "Service unavailable"}) if failed else (200, service.response)
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class FakeService(ThreadingHTTPServer):
+    """A local stand-in for a downstream service, running in a background thread.
+
+    Args:
+        response (dict): JSON returned by successful requests.
+        latency (float): mean seconds taken to answer a request.
+        error_rate (float): fraction of requests answered with a 503.
+    """
+    daemon_threads = True
+
+    def __init__(self, response, latency=0.05, error_rate=0):
+        super(FakeService, self).__init__(("127.0.0.1", 0), FakeServiceHandler)
+        self.response = response
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = Lock()
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def url(self):
+        return "http://{}:{}/".format(*self.server_address)
+
+    def __enter__(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of a list of values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class Simulation(object):
+    """Drives synthetic bags through the whole pipeline against local stand-ins for external services.
+
+    Bags are uploaded to a mocked S3 bucket, either all at once or one every
+    `arrival_interval` seconds, while the routines are run in pipeline order
+    in a loop, as `run_pipeline` does. The rights and delivery services are
+    replaced by local HTTP servers with the given latency and error rate, so
+    requests go through the same clients, retries and circuit breakers as in
+    production. All database changes are rolled back afterwards, and bags
+    other than the ones uploaded by the simulation are never counted.
+
+    Args:
+        bags (int): number of bags.
+        files (int): number of payload files in each bag.
+        file_size (int): size of each payload file, in bytes.
+        compressibility (float): fraction of each payload file which is compressible.
+        arrival_interval (float): seconds between bags being uploaded.
+        rights_latency (float): mean seconds taken by the rights service.
+        delivery_latency (float): mean seconds taken by the delivery service.
+        error_rate (float): fraction of requests to each service which fail.
+        timeout (float): seconds after which to stop, whether or not all bags
+            have been delivered.
+        retry_backoff (float): seconds before a bag which failed is retried,
+            doubled after each further failure.
+    """
+
+    def __init__(self, bags=20, files=10, file_size=64 * 1024, compressibility=0.5, arrival_interval=0,
+                 rights_latency=0.1, delivery_latency=0.1, error_rate=0, timeout=600, retry_backoff=1):
+        self.bags = bags
+        self.files = files
+        self.file_size = file_size
+        self.compressibility = compressibility
+        self.arrival_interval = arrival_interval
+        self.rights_latency = rights_latency
+        self.delivery_latency = delivery_latency
+        self.error_rate = error_rate
+        self.timeout = timeout
+        self.retry_backoff = retry_backoff
+
+    @property
+    def parameters(self):
+        return {
+            "bags": self.bags,
+            "files": self.files,
+            "file_size": self.file_size,
+            "compressibility": self.compressibility,
+            "arrival_interval": self.arrival_interval,
+            "rights_latency": self.rights_latency,
+            "delivery_latency": self.delivery_latency,
+            "error_rate": self.error_rate,
+            "timeout": self.timeout,
+            "retry_backoff": self.retry_backoff}
+
+    def run(self):
+        """Runs the simulation.
+
+        Returns:
+            results (dict): bags delivered, end-to-end latency percentiles in
+                seconds, throughput, routine failures, bags moved to the Failed
+                status and requests made to each service.
+        """
+        rights = FakeService({"rights_statements": []}, self.rights_latency, self.error_rate)
+        delivery = FakeService({}, self.delivery_latency, self.error_rate)
+        with rights, delivery, sandbox(RIGHTS_URL=rights.url, DELIVERY_URL=delivery.url, RETRY_BACKOFF=self.retry_backoff) as (root, client):
+            uploaded = {}
+            latencies = []
+            failures = failed = 0
+            start = time.monotonic()
+            while len(latencies) + failed < self.bags and time.monotonic() - start < self.timeout:
+                while len(uploaded) < self.bags and time.monotonic() - start >= len(uploaded) * self.arrival_interval:
+                    key, _ = upload_bag(client, root, self.files, self.file_size, self.compressibility, str(len(uploaded)))
+                    uploaded[key] = time.monotonic()
+                busy = False
+                for routine in ROUTINES:
+                    try:
+                        busy = bool(routine().run()[1]) or busy
+                    except Exception as e:
+                        failures += 1
+                        logger.info("%s failed: %s", routine.__name__, e)
+                if not busy:
+                    time.sleep(0.01)
+                bags = Bag.objects.filter(original_bag_name__in=list(uploaded))
+                delivered = bags.filter(process_status=Bag.DELIVERED).values_list("original_bag_name", flat=True)
+                now = time.monotonic()
+                for key in delivered:
+                    if uploaded.get(key):
+                        latencies.append(now - uploaded[key])
+                        uploaded[key] = None
+                failed = bags.filter(process_status=Bag.FAILED).count()
+            seconds = time.monotonic() - start
+        return {
+            "delivered": len(latencies),
+            "seconds": round(seconds, 3),
+            "bags_per_minute": round(len(latencies) * 60 / seconds, 3) if seconds else None,
+            "latency": {
+                name: round(percentile(latencies, fraction), 3) if latencies else None
+                for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1))},
+            "routine_failures": failures,
+            "failed": failed,
+            "requests": {
+                "rights": {"total": rights.requests, "errors": rights.errors},
+                "delivery": {"total": delivery.requests, "errors": delivery.errors}}}
@@ -1,17 +1,42 @@
+import gzip
+import hashlib
+import io
 import json
 import shutil
 import tarfile
-from os import listdir
-from os.path import exists, isdir, join
-from unittest.mock import patch
+import time
+from base64 import b64encode
+from contextlib import nullcontext
+from datetime import date, datetime, timedelta
+from datetime import timezone as dt_timezone
+from os import listdir, urandom, utime
+from os.path import exists, isdir, isfile, join
+from unittest.mock import Mock, patch
 
+import bagit
 import boto3
+import requests
+import zstandard
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
 from django.urls import reverse
+from django.utils import timezone
 from moto import mock_s3
 from rest_framework.test import APIRequestFactory
 
-from package_bag.helpers import expected_file_name
+from package_bag import json_codec
+from package_bag.benchmarks import ROUTINES, make_bag, sandbox
+from package_bag.clients import (CircuitBreaker, CircuitOpenError,
+                                 ServiceClient, ServiceRetry, get_client)
+from package_bag.compression import (ParallelGzipWriter, choose_compression,
+                                     make_tarfile)
+from package_bag.helpers import (calculate_checksums, expected_file_name,
+                                 extract_bag, manifest_algorithms,
+                                 precheck_bag, validate_bag, verify_checksums)
+from package_bag.metrics import Counter, Histogram, Registry, queue_depth
+from package_bag.profiles import ProfileRegistry, profile_registry
+from package_bag.simulation import FakeService
 from zorya import settings
 
 from .models import Bag
@@ -39,6 +64,233 @@ class TestHelpers(TestCase):
         for filename in failing_filenames:
             self.assertFalse(expected_file_name(filename))
 
+    def test_validate_bag(self):
+        """Ensures bags are validated and corrupted payload files are detected."""
+        set_up_directories([settings.TMP_DIR])
+        with tarfile.open(join(VALID_BAG_FIXTURE_DIR, "bd_bag.tar.gz"), "r") as tf:
+            tf.extractall(settings.TMP_DIR)
+        bag_path = join(settings.TMP_DIR, "bd_bag")
+        self.assertEqual(validate_bag(bag_path, workers=4).info["Origin"], "legacy_digital")
+        with open(join(bag_path, "data", "sample_file.txt"), "r+") as f:
+            f.write("X")
+        with self.assertRaises(bagit.BagValidationError) as exc:
+            validate_bag(bag_path, workers=4)
+        self.assertEqual(len(exc.exception.details), 2)
+        shutil.rmtree(settings.TMP_DIR)
+
+    def test_extract_bag(self):
+        """Ensures checksums calculated during extraction match the bag's files."""
+        set_up_directories([settings.TMP_DIR])
+        bag_path = join(settings.TMP_DIR, "bd_bag")
+        with tarfile.open(join(VALID_BAG_FIXTURE_DIR, "bd_bag.tar.gz"), "r") as tf:
+            algorithms = manifest_algorithms(tf.getnames())
+            checksums = extract_bag(tf, bag_path, algorithms)
+        self.assertEqual(algorithms, ["sha256", "sha512"])
+        self.assertTrue(isfile(join(bag_path, "data", "sample_file.txt")))
+        bag = bagit.Bag(bag_path)
+        verify_checksums(bag, checksums)
+        expected = calculate_checksums(bag)
+        self.assertEqual({path: checksums[path] for path in expected}, expected)
+        shutil.rmtree(settings.TMP_DIR)
+
+    def test_precheck_bag(self):
+        """Ensures malformed bags are detected from tar headers and tag files."""
+        set_up_directories([settings.TMP_DIR])
+        with tarfile.open(join(VALID_BAG_FIXTURE_DIR, "bd_bag.tar.gz"), "r") as tf:
+            precheck_bag(tf, profile_registry)
+            tf.extractall(settings.TMP_DIR)
+        bag_info = join(settings.TMP_DIR, "bd_bag", "bag-info.txt")
+        with open(bag_info, "r") as f:
+            tags = f.read()
+        with open(bag_info, "w") as f:
+            f.write(tags.replace("Payload-Oxum: 10.1", "Payload-Oxum: 12.1").replace("Origin: legacy_digital\n", ""))
+        with tarfile.open(join(settings.TMP_DIR, "bd_bag.tar"), "w") as tf:
+            tf.add(join(settings.TMP_DIR, "bd_bag"), arcname="bd_bag")
+        with tarfile.open(join(settings.TMP_DIR, "bd_bag.tar"), "r") as tf:
+            with self.assertRaises(bagit.BagValidationError) as exc:
+                precheck_bag(tf, profile_registry)
+        self.assertIn("Payload-Oxum", str(exc.exception))
+        self.assertIn("Required tag Origin", str(exc.exception))
+        shutil.rmtree(settings.TMP_DIR)
+
+
+class TestProfileRegistry(TestCase):
+
+    def setUp(self):
+        set_up_directories([settings.TMP_DIR])
+        shutil.copy(join(settings.BASE_DIR, "package_bag", "zorya_bagit_profile.json"), join(settings.TMP_DIR, "profile.json"))
+        self.profiles = {"default": "zorya_bagit_profile.json", "av_digitization": join(settings.TMP_DIR, "profile.json")}
+
+    def test_get(self):
+        """Ensures profiles are cached per file and reloaded when the file changes."""
+        registry = ProfileRegistry()
+        with patch('package_bag.profiles.settings.BAGIT_PROFILES', self.profiles):
+            default = registry.get("legacy_digital")
+            self.assertIs(registry.get(None), default)
+            av_profile = registry.get("av_digitization")
+            self.assertIsNot(av_profile, default)
+            self.assertIs(registry.get("av_digitization"), av_profile)
+            utime(join(settings.TMP_DIR, "profile.json"), (0, 0))
+            self.assertIsNot(registry.get("av_digitization"), av_profile)
+
+    def test_validate(self):
+        """Ensures bags are validated against the profile for their Origin."""
+        with tarfile.open(join(VALID_BAG_FIXTURE_DIR, "digitization_bag.tar.gz"), "r") as tf:
+            tf.extractall(settings.TMP_DIR)
+        bag = bagit.Bag(join(settings.TMP_DIR, "digitization_bag"))
+        self.assertEqual(profile_registry.validate(bag), [])
+        bag.info["Origin"] = "unknown"
+        self.assertEqual(len(profile_registry.validate(bag)), 1)
+
+    def tearDown(self):
+        shutil.rmtree(settings.TMP_DIR)
+
+
+class TestClients(TestCase):
+
+    def test_circuit_breaker(self):
+        """Ensures the circuit opens after repeated failures and closes after a successful trial call."""
+        breaker = CircuitBreaker(2, 30)
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_failure()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+        with patch('package_bag.clients.time.monotonic', return_value=breaker.opened_at + 31):
+            breaker.before_call()
+            with self.assertRaises(CircuitOpenError):
+                breaker.before_call()
+        breaker.record_success()
+        breaker.before_call()
+
+    @patch('package_bag.clients.Session.request')
+    def test_request(self, mock_request):
+        """Ensures requests use the default timeout and server errors are counted by the circuit breaker."""
+        client = ServiceClient()
+        mock_request.return_value.status_code = 503
+        for _ in range(settings.CIRCUIT_BREAKER_THRESHOLD):
+            client.request("POST", "http://rights.example.com/api", json={})
+        self.assertEqual(mock_request.call_args[1]["timeout"], settings.HTTP_TIMEOUT)
+        with self.assertRaises(CircuitOpenError):
+            client.request("POST", "http://rights.example.com/api", json={})
+        self.assertEqual(mock_request.call_count, settings.CIRCUIT_BREAKER_THRESHOLD)
+
+    def test_retry(self):
+        """Ensures only idempotent requests are retried after server errors, and POSTs only when the service asks."""
+        retry = ServiceClient().session.get_adapter("http://rights.example.com").max_retries
+        self.assertIsInstance(retry, ServiceRetry)
+        self.assertTrue(retry.is_retry("PUT", 502))
+        self.assertTrue(retry.is_retry("GET", 503))
+        self.assertFalse(retry.is_retry("POST", 502))
+        self.assertFalse(retry.is_retry("POST", 503))
+        self.assertTrue(retry.is_retry("POST", 503, has_retry_after=True))
+        self.assertTrue(retry.is_retry("POST", 429, has_retry_after=True))
+        self.assertFalse(retry.is_retry("POST", 504, has_retry_after=True))
+        self.assertFalse(retry.new().is_retry("POST", 502))
+        idempotent_retry = ServiceClient().idempotent_session.get_adapter("http://rights.example.com").max_retries
+        self.assertTrue(idempotent_retry.is_retry("POST", 502))
+        self.assertTrue(idempotent_retry.new().is_retry("POST", 504))
+
+    @patch('package_bag.clients.Session.request', autospec=True)
+    def test_idempotent_request(self, mock_request):
+        """Ensures requests marked as idempotent are sent through the session which retries them."""
+        client = ServiceClient()
+        mock_request.return_value.status_code = 200
+        client.request("POST", "http://rights.example.com/api", json={}, idempotent=True)
+        self.assertIs(mock_request.call_args[0][0], client.idempotent_session)
+        client.request("POST", "http://delivery.example.com/api", json={})
+        self.assertIs(mock_request.call_args[0][0], client.session)
+
+    def test_get_client(self):
+        """Ensures one client is shared per service."""
+        client = get_client("http://rights.example.com/api/rights")
+        self.assertIs(get_client("http://rights.example.com/other"), client)
+        self.assertIsNot(get_client("http://delivery.example.com/api"), client)
+
+
+class TestCompression(TestCase):
+
+    def test_parallel_gzip_writer(self):
+        """Ensures blocks compressed in parallel form a single standard gzip stream."""
+        data = b"".join(str(i).encode() for i in range(200000))
+        output = io.BytesIO()
+        with ParallelGzipWriter(output, workers=4, block_size=64 * 1024) as writer:
+            for start in range(0, len(data), 10000):
+                writer.write(data[start:start + 10000])
+        self.assertEqual(gzip.decompress(output.getvalue()), data)
+        self.assertLess(len(output.getvalue()), len(data))
+
+    def test_choose_compression(self):
+        """Ensures incompressible directories are stored and compressible ones are compressed."""
+        set_up_directories([settings.TMP_DIR])
+        with open(join(settings.TMP_DIR, "image.jpg"), "wb") as f:
+            f.write(b"a" * 100000)
+        with open(join(settings.TMP_DIR, "audio.wav"), "wb") as f:
+            f.write(urandom(100000))
+        decision = choose_compression(settings.TMP_DIR)
+        self.assertEqual((decision["strategy"], decision["level"]), ("store", 0))
+        decision = choose_compression(settings.TMP_DIR, "zstd")
+        self.assertEqual((decision["strategy"], decision["level"]), ("fastest", -5))
+        with open(join(settings.TMP_DIR, "transcript.txt"), "wb") as f:
+            f.write(b"transcript " * 100000)
+        decision = choose_compression(settings.TMP_DIR, "zstd")
+        self.assertEqual((decision["format"], decision["strategy"], decision["level"]), ("zstd", "default", 3))
+        shutil.rmtree(settings.TMP_DIR)
+
+    def test_make_tarfile(self):
+        """Ensures directories are archived with gzip and zstd, and removed."""
+        set_up_directories([settings.TMP_DIR])
+        with tarfile.open(join(VALID_BAG_FIXTURE_DIR, "digitization_bag.tar.gz"), "r") as tf:
+            tf.extractall(settings.TMP_DIR)
+            expected = tf.getnames()
+        bag_path = join(settings.TMP_DIR, "digitization_bag")
+        make_tarfile(bag_path, "{}.tar.gz".format(bag_path), workers=2, remove_src=True)
+        self.assertFalse(isdir(bag_path))
+        with tarfile.open("{}.tar.gz".format(bag_path), "r:gz") as tf:
+            self.assertEqual(set(tf.getnames()), set(expected))
+            tf.extractall(settings.TMP_DIR)
+        make_tarfile(bag_path, "{}.tar.zst".format(bag_path), "zstd", workers=2, remove_src=True)
+        with open("{}.tar.zst".format(bag_path), "rb") as f:
+            with tarfile.open(fileobj=zstandard.ZstdDecompressor().stream_reader(f), mode="r|") as tf:
+                self.assertEqual(set(tf.getnames()), set(expected))
+        shutil.rmtree(settings.TMP_DIR)
+
+
+class TestJsonCodec(TestCase):
+
+    @patch('package_bag.json_codec.orjson', None)
+    def test_dump(self):
+        """Ensures JSON streamed to a file matches JSON encoded at once, with and without indentation."""
+        data = {"rights_statements": [{"note": "Statement {}".format(i), "start_date": date(2020, 1, 1)} for i in range(10000)]}
+        for pretty in [True, False]:
+            output = io.BytesIO()
+            json_codec.dump(data, output, pretty)
+            self.assertEqual(output.getvalue(), json_codec.dumps(data, pretty))
+        self.assertEqual(json_codec.dumps({"b": 1, "a": [1]}), b'{"a":[1],"b":1}')
+        self.assertEqual(json_codec.loads(output.getvalue())["rights_statements"][0]["start_date"], "2020-01-01")
+
+    def test_backends_match(self):
+        """Ensures orjson and the standard library encode the same object identically."""
+        data = {
+            "note": "Rockefeller Archive Center — Sleepy Hollow",
+            "dates": [date(2020, 1, 1), datetime(2020, 1, 1, 12, 30, 15, 250, tzinfo=dt_timezone.utc), datetime(2020, 1, 1)],
+            "values": [1, 2.5, True, None, {}, []]}
+        for pretty in [False, True]:
+            encoded = json_codec.dumps(data, pretty)
+            with patch('package_bag.json_codec.orjson', None):
+                self.assertEqual(json_codec.dumps(data, pretty), encoded)
+                output = io.BytesIO()
+                json_codec.dump(data, output, pretty)
+                self.assertEqual(output.getvalue(), encoded)
+
+    def test_pretty(self):
+        """Ensures pretty JSON is indented by four spaces, as package JSON always has been."""
+        data = {"identifier": "bag", "rights_statements": [{"start_date": date(2020, 1, 1)}]}
+        self.assertEqual(json_codec.dumps(data, pretty=True), json.dumps(data, indent=4, sort_keys=True, default=str).encode("utf-8"))
+        output = io.BytesIO()
+        json_codec.dump(data, output, pretty=True)
+        self.assertEqual(output.getvalue(), json_codec.dumps(data, pretty=True))
+
 
 class TestS3Finder(TestCase):
     fixtures = ["s3_finder.json"]
@@ -82,6 +334,37 @@ class TestS3Finder(TestCase):
         list_to_download = object_finder.list_to_download()
         self.assertEqual(len(list_to_download), 2)
 
+    @mock_s3
+    def test_run_concurrent_finders(self):
+        """Ensures bags saved by another finder after listing are not duplicated."""
+        object_finder = self.configure_uploader(["7d24b2da347b48fe9e59d8c5d4424235.tar"])
+        list_to_download = object_finder.list_to_download()
+        S3ObjectFinder().run()
+        with patch.object(object_finder, "list_to_download", return_value=list_to_download):
+            object_finder.run()
+        self.assertEqual(Bag.objects.filter(original_bag_name="7d24b2da347b48fe9e59d8c5d4424235.tar").count(), 1)
+
+    @mock_s3
+    def test_run_duplicates(self):
+        """Ensures objects with the same content as a saved bag or another new object are saved as duplicates
+        and deleted from the bucket.
+
+        Of the two new objects with the same content, the one uploaded first, whose key also sorts first, is the original."""
+        object_finder = self.configure_uploader([])
+        original = Bag.objects.create(original_bag_name="e54b6e1bca424b6a9c4d1ad7d2d5b04b.tar", bag_identifier="original",
+                                      s3_etag=hashlib.md5(b"first").hexdigest(), process_status=Bag.DELIVERED)
+        for key, body in [("7d24b2da347b48fe9e59d8c5d4424235.tar", b"first"), ("1f0e8b6c2a8d4f3e9b7c6d5e4f3a2b1c.tar", b"second"),
+                          ("4b4334fba43a4cf4940f6c8e6d892f60.tar", b"second")]:
+            object_finder.bucket.put_object(Key=key, Body=body)
+        object_finder.run()
+        duplicate = Bag.objects.get(original_bag_name="7d24b2da347b48fe9e59d8c5d4424235.tar")
+        self.assertEqual(duplicate.process_status, Bag.DUPLICATE)
+        self.assertEqual(duplicate.duplicate_of, original)
+        new = Bag.objects.get(original_bag_name="1f0e8b6c2a8d4f3e9b7c6d5e4f3a2b1c.tar")
+        self.assertEqual(new.process_status, Bag.SAVED)
+        self.assertEqual(Bag.objects.get(original_bag_name="4b4334fba43a4cf4940f6c8e6d892f60.tar").duplicate_of, new)
+        self.assertEqual([obj.key for obj in object_finder.bucket.objects.all()], ["1f0e8b6c2a8d4f3e9b7c6d5e4f3a2b1c.tar"])
+
 
 class TestS3Download(TestCase):
     fixtures = ["s3_download.json"]
@@ -115,6 +398,21 @@ class TestS3Download(TestCase):
         S3ObjectDownloader().run()
         self.assertTrue(exists(join(settings.SRC_DIR, "4b1bf39c6b6745408ac8de9a5aec34ba.tar")))
 
+    @mock_s3
+    @patch('package_bag.routines.settings.S3_STREAM_EXTRACT', True)
+    def test_run_stream_extract(self):
+        """Tests that objects can be streamed from S3 directly into an extracted bag"""
+        set_up_directories([settings.SRC_DIR, settings.TMP_DIR])
+        object_downloader = self.configure_uploader([])
+        object_downloader.bucket.upload_file(join(VALID_BAG_FIXTURE_DIR, "bd_bag.tar.gz"), "4b1bf39c6b6745408ac8de9a5aec34ba.tar")
+        S3ObjectDownloader().run()
+        bag = Bag.objects.get(pk=1)
+        self.assertEqual(bag.process_status, Bag.DOWNLOADED)
+        self.assertEqual(bag.bag_path, join(settings.TMP_DIR, bag.bag_identifier))
+        self.assertTrue(isdir(join(bag.bag_path, "data")))
+        self.assertEqual(listdir(settings.SRC_DIR), [])
+        self.assertEqual(list(object_downloader.bucket.objects.all()), [])
+
     @mock_s3
     def test_download_object_from_s3(self,):
         """Tests that object is downloaded from the S3 bucket to the source directory"""
@@ -124,6 +422,47 @@ class TestS3Download(TestCase):
         object_downloader.download_object_from_s3(object_to_download)
         self.assertIn(object_to_download, listdir(object_downloader.src_dir))
 
+    @mock_s3
+    @patch('package_bag.routines.settings.S3_DOWNLOAD_PART_SIZE', 3)
+    def test_download_object_in_ranges(self):
+        """Tests that objects are downloaded in ranges, resuming from previously completed ranges"""
+        set_up_directories([settings.SRC_DIR])
+        object_downloader = self.configure_uploader([])
+        object_to_download = "7d24b2da347b48fe9e59d8c5d4424235.tar"
+        body = b"0123456789abcdefghij"
+        object_downloader.bucket.put_object(Key=object_to_download, Body=body)
+        partial_file = join(settings.SRC_DIR, "{}.part".format(object_to_download))
+        with open(partial_file, "wb") as f:
+            f.write(body[:3])
+        with open("{}.json".format(partial_file), "w") as f:
+            etag = object_downloader.bucket.Object(object_to_download).e_tag
+            json.dump({"etag": etag, "size": len(body), "part_size": 3, "completed": [0]}, f)
+        client = object_downloader.bucket.meta.client
+        with patch.object(client, "get_object", wraps=client.get_object) as mock_get:
+            downloaded_file = object_downloader.download_object_from_s3(object_to_download)
+        self.assertEqual(mock_get.call_count, 6)
+        with open(downloaded_file, "rb") as f:
+            self.assertEqual(f.read(), body)
+        self.assertEqual(listdir(settings.SRC_DIR), [object_to_download])
+
+    @mock_s3
+    def test_download_object_checksum_mismatch(self):
+        """Tests that corrupted downloads are rejected and discarded"""
+        set_up_directories([settings.SRC_DIR])
+        object_downloader = self.configure_uploader([])
+        object_to_download = "7d24b2da347b48fe9e59d8c5d4424235.tar"
+        object_downloader.bucket.put_object(Key=object_to_download, Body=b"0123456789")
+        partial_file = join(settings.SRC_DIR, "{}.part".format(object_to_download))
+        with open(partial_file, "wb") as f:
+            f.write(b"corrupted!")
+        with open("{}.json".format(partial_file), "w") as f:
+            etag = object_downloader.bucket.Object(object_to_download).e_tag
+            json.dump({"etag": etag, "size": 10, "part_size": settings.S3_DOWNLOAD_PART_SIZE, "completed": [0]}, f)
+        with self.assertRaises(Exception) as exc:
+            object_downloader.download_object_from_s3(object_to_download)
+        self.assertIn("Checksum mismatch", str(exc.exception))
+        self.assertEqual(listdir(settings.SRC_DIR), [])
+
     @mock_s3
     def test_delete_object_from_s3(self):
         """Tests that object is deleted from the S3 bucket"""
@@ -155,6 +494,44 @@ class TestBagDiscoverer(TestCase):
         self.assertEqual(len(Bag.objects.all()), valid_bags, "Wrong number of bags saved in database.")
         self.assertEqual(len(listdir(settings.TMP_DIR)), valid_bags)
 
+    @patch('package_bag.helpers.calculate_checksums')
+    def test_run_without_rehashing(self, mock_calculate):
+        """Ensures files hashed during extraction are not read again for validation."""
+        shutil.rmtree(settings.SRC_DIR)
+        shutil.copytree(VALID_BAG_FIXTURE_DIR, settings.SRC_DIR)
+        BagDiscoverer().run()
+        mock_calculate.assert_not_called()
+        self.assertEqual(Bag.objects.filter(process_status=Bag.DISCOVERED).count(), 1)
+
+    def test_run_duplicate(self):
+        """Ensures a bag with the same payload and metadata as an earlier bag is taken out of the pipeline."""
+        shutil.copy(join(VALID_BAG_FIXTURE_DIR, "bd_bag.tar.gz"), join(settings.SRC_DIR, "bd_bag.tar.gz"))
+        shutil.copy(join(VALID_BAG_FIXTURE_DIR, "bd_bag.tar.gz"), join(settings.SRC_DIR, "bd_bag_copy.tar.gz"))
+        Bag.objects.filter(pk=1).update(bag_path=join(settings.SRC_DIR, "bd_bag.tar.gz"))
+        Bag.objects.filter(pk=2).update(bag_path=join(settings.SRC_DIR, "bd_bag_copy.tar.gz"))
+        BagDiscoverer().run()
+        BagDiscoverer().run()
+        original, duplicate = Bag.objects.get(pk=1), Bag.objects.get(pk=2)
+        self.assertEqual(original.process_status, Bag.DISCOVERED)
+        self.assertEqual(duplicate.process_status, Bag.DUPLICATE)
+        self.assertEqual(duplicate.duplicate_of, original)
+        self.assertEqual(duplicate.payload_fingerprint, original.payload_fingerprint)
+        self.assertEqual(listdir(settings.TMP_DIR), [original.bag_identifier])
+
+    @patch('package_bag.routines.precheck_bag')
+    def test_precheck_uncompressed_only(self, mock_precheck):
+        """Ensures only uncompressed bags are prechecked, since reading the headers of a compressed bag decompresses all of it."""
+        shutil.copy(join(VALID_BAG_FIXTURE_DIR, "bd_bag.tar.gz"), join(settings.SRC_DIR, "bd_bag.tar.gz"))
+        with gzip.open(join(VALID_BAG_FIXTURE_DIR, "bd_bag.tar.gz"), "rb") as source, open(join(settings.SRC_DIR, "bd_bag.tar"), "wb") as f:
+            shutil.copyfileobj(source, f)
+        Bag.objects.filter(pk=1).update(bag_path=join(settings.SRC_DIR, "bd_bag.tar.gz"))
+        Bag.objects.filter(pk=2).update(bag_path=join(settings.SRC_DIR, "bd_bag.tar"))
+        BagDiscoverer().run()
+        mock_precheck.assert_not_called()
+        BagDiscoverer().run()
+        mock_precheck.assert_called_once()
+        self.assertEqual(mock_precheck.call_args[0][0].name, join(settings.SRC_DIR, "bd_bag.tar"))
+
     def tearDown(self):
         for d in [settings.TMP_DIR, settings.SRC_DIR]:
             if isdir(d):
@@ -165,7 +542,7 @@ class TestBagDiscovererInvalid(TestCase):
 
     @patch('package_bag.routines.BagDiscoverer.__init__')
     @patch('package_bag.routines.BagDiscoverer.unpack_rename')
-    @patch('package_bag.routines.validate')
+    @patch('package_bag.routines.validate_bag')
     def test_invalid_bag(self, mock_init, mock_unpack, mock_validate):
         mock_init.return_value = None
         mock_unpack.return_value = "/path/to/bag.tar"
@@ -175,6 +552,130 @@ class TestBagDiscovererInvalid(TestCase):
         self.assertEqual(str(context.exception), "message")
 
 
+class TestBaseRoutine(TestCase):
+    fixtures = ["get_rights.json"]
+
+    def setUp(self):
+        with open(join(RIGHTS_FIXTURE_DIR, 'rights_service_response.json')) as json_file:
+            self.rights_service_response = json.load(json_file)
+        in_process = Bag.objects.first()
+        in_process.process_status = Bag.ASSIGNING_RIGHTS
+        in_process.lease_expires = timezone.now() + timedelta(hours=1)
+        in_process.save()
+        cache.clear()
+
+    @patch('package_bag.routines.settings.ROUTINE_CONCURRENCY', {"default": 1})
+    def test_concurrency_limit_reached(self):
+        """Ensures no bag is claimed while a routine is at its concurrency limit."""
+        self.assertEqual(RightsAssigner().run(), ("Service currently running", []))
+        self.assertEqual(Bag.objects.filter(process_status=Bag.DISCOVERED).count(), 2)
+
+    @patch('package_bag.routines.post')
+    @patch('package_bag.routines.settings.ROUTINE_CONCURRENCY', {"default": 1, "RightsAssigner": 2})
+    def test_concurrent_claims(self, mock_rights):
+        """Ensures a bag is claimed while another is in process if the limit allows."""
+        mock_rights.return_value.status_code = 200
+        mock_rights.return_value.content = json.dumps(self.rights_service_response)
+        msg, identifiers = RightsAssigner().run()
+        self.assertEqual(msg, "Rights assigned.")
+        self.assertEqual(len(identifiers), 1)
+        self.assertEqual(Bag.objects.get(bag_identifier=identifiers[0]).process_status, Bag.ASSIGNED_RIGHTS)
+        self.assertEqual(Bag.objects.filter(process_status=Bag.ASSIGNING_RIGHTS).count(), 1)
+
+    @patch('package_bag.routines.settings.ROUTINE_CONCURRENCY', {"default": 5})
+    def test_claim_bags(self):
+        """Ensures claimed bags are moved into the routine's in process status."""
+        claimed = RightsAssigner().claim_bags()
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(claimed[0].process_status, Bag.ASSIGNING_RIGHTS)
+        self.assertEqual(Bag.objects.filter(process_status=Bag.ASSIGNING_RIGHTS).count(), 2)
+        self.assertEqual(len(RightsAssigner().claim_bags(5)), 1)
+        self.assertEqual(RightsAssigner().claim_bags(), [])
+
+    @patch('package_bag.routines.settings.ROUTINE_CONCURRENCY', {"default": 2})
+    def test_claim_bags_concurrency_limit(self):
+        """Ensures claims never take a routine past its concurrency limit."""
+        self.assertEqual(len(RightsAssigner().claim_bags(5)), 1)
+        self.assertEqual(RightsAssigner().claim_bags(5), [])
+        self.assertEqual(Bag.objects.filter(process_status=Bag.DISCOVERED).count(), 1)
+
+    @patch('package_bag.routines.post')
+    @patch('package_bag.routines.settings.MAX_ATTEMPTS', 2)
+    @patch('package_bag.routines.settings.ROUTINE_CONCURRENCY', {"default": 5})
+    def test_failure_backoff(self, mock_rights):
+        """Ensures failed bags are retried after a delay, moved to the Failed status after too many attempts, and can be requeued."""
+        mock_rights.side_effect = Exception("Rights service unavailable")
+        with self.assertRaises(Exception):
+            RightsAssigner().run()
+        failed = Bag.objects.get(pk=2)
+        self.assertEqual(failed.process_status, Bag.DISCOVERED)
+        self.assertEqual(failed.attempts, 1)
+        self.assertEqual(failed.last_error, "Exception: Rights service unavailable")
+        self.assertGreater(failed.next_attempt, timezone.now())
+        with self.assertRaises(Exception):
+            RightsAssigner().run()
+        self.assertEqual(Bag.objects.get(pk=3).attempts, 1, "Bag waiting to be retried was claimed.")
+
+        Bag.objects.filter(pk=2).update(next_attempt=timezone.now())
+        with self.assertRaises(Exception):
+            RightsAssigner().run()
+        failed.refresh_from_db()
+        self.assertEqual(failed.process_status, Bag.FAILED)
+        self.assertEqual(failed.retry_status, Bag.DISCOVERED)
+        self.assertIsNone(failed.next_attempt)
+
+        response = self.client.post(reverse("bag-requeue", args=[2]))
+        self.assertEqual(response.status_code, 200)
+        failed.refresh_from_db()
+        self.assertEqual((failed.process_status, failed.attempts, failed.next_attempt), (Bag.DISCOVERED, 0, None))
+        self.assertEqual(self.client.post(reverse("bag-requeue", args=[2])).status_code, 400)
+
+    @patch('package_bag.routines.post')
+    def test_reclaim_expired_lease(self, mock_rights):
+        """Ensures a bag whose lease has expired is reclaimed, so the routine is no longer blocked."""
+        mock_rights.return_value.status_code = 200
+        mock_rights.return_value.content = json.dumps(self.rights_service_response)
+        Bag.objects.filter(pk=1).update(lease_expires=timezone.now() - timedelta(seconds=1))
+        msg, identifiers = RightsAssigner().run()
+        self.assertEqual(identifiers, [Bag.objects.get(pk=2).bag_identifier])
+        reclaimed = Bag.objects.get(pk=1)
+        self.assertEqual((reclaimed.process_status, reclaimed.attempts, reclaimed.lease_expires), (Bag.DISCOVERED, 1, None))
+        self.assertIn("Lease expired", reclaimed.last_error)
+        self.assertIsNone(Bag.objects.get(pk=2).lease_expires)
+
+    @patch('package_bag.routines.settings.ROUTINE_CONCURRENCY', {"default": 5})
+    def test_renew_lease(self):
+        """Ensures leases are renewed for bags still in process."""
+        routine = RightsAssigner()
+        claimed = routine.claim_bags()
+        lease_expires = claimed[0].lease_expires
+        self.assertGreater(lease_expires, timezone.now())
+        routine.renew_lease(claimed)
+        self.assertGreater(Bag.objects.get(pk=claimed[0].pk).lease_expires, lease_expires)
+        self.assertEqual(Bag.objects.get(pk=claimed[0].pk).lease_expires, claimed[0].lease_expires)
+
+    @patch('package_bag.routines.settings.ROUTINE_CONCURRENCY', {"default": 5})
+    def test_lost_lease(self):
+        """Ensures a bag reclaimed by another worker is not overwritten when the worker which lost it finishes."""
+        routine = RightsAssigner()
+        claimed = routine.claim_bags()[0]
+        Bag.objects.filter(pk=claimed.pk).update(process_status=Bag.DISCOVERED, lease_expires=None, attempts=1)
+        routine.renew_lease([claimed])
+        self.assertIsNone(Bag.objects.get(pk=claimed.pk).lease_expires)
+        self.assertFalse(routine.finish_bag(claimed))
+        self.assertEqual((Bag.objects.get(pk=claimed.pk).process_status, Bag.objects.get(pk=claimed.pk).attempts), (Bag.DISCOVERED, 1))
+
+    @patch('package_bag.routines.settings.LEASE_DURATION', 0.03)
+    @patch('package_bag.routines.connection')
+    def test_heartbeat_survives_errors(self, mock_connection):
+        """Ensures the heartbeat keeps renewing leases after a renewal fails."""
+        routine = RightsAssigner()
+        with patch.object(routine, "renew_lease", side_effect=[Exception("Database unavailable")] + [None] * 100) as mock_renew:
+            with routine.heartbeat([Bag.objects.get(pk=1)]):
+                time.sleep(0.1)
+        self.assertGreater(mock_renew.call_count, 1)
+
+
 class TestRightsAssigner(TestCase):
     fixtures = ["get_rights.json"]
 
@@ -183,26 +684,42 @@ class TestRightsAssigner(TestCase):
             self.rights_service_response = json.load(json_file)
         set_up_directories([settings.TMP_DIR, settings.SRC_DIR, settings.DEST_DIR])
         self.records_in_db = 3
+        cache.clear()
 
     @patch('package_bag.routines.post')
     def test_run(self, mock_rights):
         """Ensures that rights are correctly retrieved and assigned."""
         mock_rights.return_value.status_code = 200
-        mock_rights.return_value.json.return_value = self.rights_service_response
+        mock_rights.return_value.content = json.dumps(self.rights_service_response)
         for bag in Bag.objects.filter(process_status=Bag.DISCOVERED):
             assign_rights = RightsAssigner().run()
             mock_rights.assert_called_with(
                 settings.RIGHTS_URL,
-                json={'identifiers': RIGHTS_ID, 'start_date': None, 'end_date': END_DATE})
+                json={'identifiers': RIGHTS_ID, 'start_date': None, 'end_date': END_DATE}, idempotent=True)
             self.assertIsNot(False, assign_rights)
         self.assertEqual(
-            mock_rights.call_count, self.records_in_db,
+            mock_rights.call_count, 1,
             "Incorrect number of calls to rights service.")
         for obj in Bag.objects.all():
             self.assertEqual(
                 obj.rights_data, self.rights_service_response["rights_statements"],
                 "Rights JSON was not correctly added to bag in database.")
 
+    @patch('package_bag.routines.post')
+    @patch('package_bag.routines.settings.RIGHTS_BATCH_SIZE', 5)
+    @patch('package_bag.routines.settings.ROUTINE_CONCURRENCY', {"default": 5})
+    def test_run_batch(self, mock_rights):
+        """Ensures that a batch of bags is assigned rights in one run."""
+        mock_rights.return_value.status_code = 200
+        mock_rights.return_value.content = json.dumps(self.rights_service_response)
+        bag = Bag.objects.last()
+        bag.end_date = "2022-01-01"
+        bag.save()
+        msg, identifiers = RightsAssigner().run()
+        self.assertEqual(len(identifiers), self.records_in_db)
+        self.assertEqual(mock_rights.call_count, 2, "Incorrect number of calls to rights service.")
+        self.assertEqual(Bag.objects.filter(process_status=Bag.ASSIGNED_RIGHTS).count(), self.records_in_db)
+
     @patch('package_bag.routines.post')
     def test_run_exception(self, mock_rights):
         reason = "foobar"
@@ -246,6 +763,46 @@ class TestPackageMaker(TestCase):
         self.assertEqual(
             len(listdir(settings.DEST_DIR)), self.records_in_db,
             "Incorrect number of binaries in destination directory.")
+        for bag_id in listdir(settings.DEST_DIR):
+            package_root = join(settings.DEST_DIR, bag_id)
+            self.assertEqual(sorted(listdir(package_root)), ["{}.json".format(bag_id), "{}.tar.gz".format(bag_id)])
+            with open(join(package_root, "{}.json".format(bag_id))) as f:
+                package_json = json.load(f)
+            self.assertEqual(package_json["identifier"], bag_id)
+            self.assertEqual(package_json["compression"]["strategy"], "default")
+            with tarfile.open(join(package_root, "{}.tar.gz".format(bag_id)), "r:gz") as bag_tf:
+                self.assertIn(join(bag_id, "bagit.txt"), bag_tf.getnames())
+
+    @patch('package_bag.routines.settings.PACKAGE_FORMAT', "tar")
+    def test_run_single_pass(self):
+        """Ensures that packages are written straight into an archive if configured."""
+        copy_binaries(VALID_BAG_FIXTURE_DIR, settings.SRC_DIR)
+        for bag in Bag.objects.filter(process_status=Bag.ASSIGNED_RIGHTS):
+            PackageMaker().run()
+        self.assertEqual(
+            len(listdir(settings.DEST_DIR)), self.records_in_db,
+            "Incorrect number of binaries in destination directory.")
+        for package in listdir(settings.DEST_DIR):
+            with tarfile.open(join(settings.DEST_DIR, package), "r:") as tf:
+                bag_id = package.replace(".tar", "")
+                expected = [bag_id, join(bag_id, "{}.json".format(bag_id)), join(bag_id, "{}.tar.gz".format(bag_id))]
+                self.assertEqual(tf.getnames(), expected)
+                package_json = json.load(tf.extractfile(expected[1]))
+                self.assertEqual(package_json["identifier"], bag_id)
+                self.assertEqual(package_json["compression"]["strategy"], "default")
+                with tarfile.open(fileobj=tf.extractfile(expected[2]), mode="r:gz") as bag_tf:
+                    self.assertIn(join(bag_id, "bagit.txt"), bag_tf.getnames())
+
+    def test_reclaim_bags(self):
+        """Ensures a partially written package is removed when its bag is reclaimed."""
+        bag = Bag.objects.first()
+        Bag.objects.filter(pk=bag.pk).update(process_status=Bag.PACKAGING)
+        part_path = join(settings.DEST_DIR, "{}.tar.part".format(bag.bag_identifier))
+        with open(part_path, "wb") as f:
+            f.write(b"partial")
+        self.assertEqual(PackageMaker().reclaim_bags(), [bag])
+        self.assertFalse(exists(part_path))
+        self.assertEqual(Bag.objects.get(pk=bag.pk).process_status, Bag.ASSIGNED_RIGHTS)
 
     def tearDown(self):
         for d in [settings.TMP_DIR, settings.SRC_DIR, settings.DEST_DIR]:
@@ -278,6 +835,13 @@ class TestPackageArchiver(TestCase):
                     set(expected), set(names),
                     "Incorrectly structured package: expected {} but got {}".format(expected, names))
 
+    def test_run_archived_package(self):
+        """Ensures that packages which are already archived are left alone."""
+        with open(join(settings.DEST_DIR, "8a20be92-0b6d-4cb6-964e-f90764302c56.tar"), "wb"):
+            pass
+        self.assertEqual(PackageArchiver().run()[0], "Package archive created.")
+        self.assertEqual(listdir(settings.DEST_DIR), ["8a20be92-0b6d-4cb6-964e-f90764302c56.tar"])
+
     def tearDown(self):
         for d in [settings.TMP_DIR, settings.SRC_DIR, settings.DEST_DIR]:
             if isdir(d):
@@ -307,12 +871,256 @@ class TestPackageDeliverer(TestCase):
             mock_post.call_count, self.records_in_db,
             "Incorrect number of update requests made.")
 
+    @patch('package_bag.routines.post')
+    @patch('package_bag.routines.settings.DELIVERY_BATCH_SIZE', 5)
+    @patch('package_bag.routines.settings.REQUESTS_IN_FLIGHT', 3)
+    @patch('package_bag.routines.settings.ROUTINE_CONCURRENCY', {"default": 5})
+    def test_run_concurrently(self, mock_post):
+        """Ensures that a batch of packages is delivered concurrently, and failed deliveries are returned to the queue."""
+        failed = Bag.objects.first()
+
+        def deliver(url, data, headers):
+            if json.loads(data)["bag_identifier"] == failed.bag_identifier:
+                raise Exception("Delivery failed")
+            return mock_post.return_value
+
+        mock_post.side_effect = deliver
+        with self.assertRaises(Exception) as exc:
+            PackageDeliverer().run()
+        self.assertIn("Delivery failed", str(exc.exception))
+        self.assertEqual(mock_post.call_count, self.records_in_db)
+        self.assertEqual(Bag.objects.get(pk=failed.pk).process_status, Bag.TAR)
+        self.assertEqual(Bag.objects.filter(process_status=Bag.DELIVERED).count(), self.records_in_db - 1)
+
+    @patch('package_bag.routines.post')
+    @patch('package_bag.routines.put')
+    @patch('package_bag.routines.head')
+    @patch('package_bag.routines.settings.DELIVERY_UPLOAD_URL', 'http://ursa-major-web:8005/uploads/')
+    @patch('package_bag.routines.settings.DELIVERY_UPLOAD_CHUNK_SIZE', 1000)
+    def test_upload_package(self, mock_head, mock_put, mock_post):
+        """Ensures packages are uploaded in chunks, resuming an interrupted upload, with a digest of the whole package."""
+        bag = Bag.objects.first()
+        content = urandom(2500)
+        with open(join(settings.DEST_DIR, "{}.tar".format(bag.bag_identifier)), "wb") as f:
+            f.write(content)
+        mock_head.return_value = Mock(status_code=200, headers={"Upload-Offset": "500"})
+        package_url = "http://ursa-major-web:8005/uploads/{}.tar".format(bag.bag_identifier)
+        PackageDeliverer().process_bag(bag)
+        mock_head.assert_called_once_with(package_url)
+        self.assertEqual(
+            [c.kwargs["headers"]["Content-Range"] for c in mock_put.call_args_list],
+            ["bytes 500-1499/2500", "bytes 1500-2499/2500"])
+        self.assertEqual(b"".join(c.kwargs["data"] for c in mock_put.call_args_list), content[500:])
+        self.assertNotIn("Digest", mock_put.call_args_list[0].kwargs["headers"])
+        self.assertEqual(
+            mock_put.call_args_list[-1].kwargs["headers"]["Digest"],
+            "sha-256={}".format(b64encode(hashlib.sha256(content).digest()).decode()))
+        self.assertEqual(json.loads(mock_post.call_args.kwargs["data"])["package_url"], package_url)
+
+        mock_head.return_value = Mock(status_code=404)
+        mock_put.reset_mock()
+        PackageDeliverer().process_bag(bag)
+        self.assertEqual(mock_put.call_count, 3)
+        self.assertEqual(mock_put.call_args_list[0].kwargs["headers"]["Content-Range"], "bytes 0-999/2500")
+
     def tearDown(self):
         for d in [settings.TMP_DIR, settings.SRC_DIR, settings.DEST_DIR]:
             if isdir(d):
                 shutil.rmtree(d)
 
 
+class TestRunPipeline(TestCase):
+
+    def test_run_pipeline(self):
+        """Ensures every routine runs in order, and a failing routine does not stop the others."""
+        calls = []
+
+        def routine(name, result):
+            def run():
+                calls.append(name)
+                if isinstance(result, Exception):
+                    raise result
+                return result
+            return Mock(__name__=name, return_value=Mock(run=run))
+
+        pipeline = [
+            routine("S3ObjectFinder", ("No new objects.", [])),
+            routine("BagDiscoverer", Exception("Invalid bag")),
+            routine("RightsAssigner", ("Rights assigned.", ["1"]))]
+        output = io.StringIO()
+        with patch('package_bag.management.commands.run_pipeline.PIPELINE', pipeline):
+            call_command("run_pipeline", once=True, stdout=output)
+        self.assertEqual(calls, ["S3ObjectFinder", "BagDiscoverer", "RightsAssigner"])
+        self.assertIn("Pipeline stopped.", output.getvalue())
+
+
+class TestMetrics(TestCase):
+    fixtures = ["get_rights.json"]
+
+    def setUp(self):
+        cache.clear()
+
+    def test_render(self):
+        """Ensures metrics are rendered in the Prometheus text exposition format."""
+        registry = Registry()
+        counter = registry.register(Counter("runs_total", "Runs.", ["routine"]))
+        histogram = registry.register(Histogram("run_seconds", "Run time.", ["routine"], buckets=(1, 10)))
+        counter.inc(routine="RightsAssigner")
+        counter.inc(2, routine="RightsAssigner")
+        histogram.observe(5, routine="RightsAssigner")
+        rendered = registry.render().splitlines()
+        self.assertIn('runs_total{routine="RightsAssigner"} 3', rendered)
+        self.assertIn('run_seconds_bucket{routine="RightsAssigner",le="1"} 0', rendered)
+        self.assertIn('run_seconds_bucket{routine="RightsAssigner",le="+Inf"} 1', rendered)
+        self.assertIn('run_seconds_count{routine="RightsAssigner"} 1', rendered)
+
+    @patch('package_bag.routines.post')
+    def test_metrics_view(self, mock_rights):
+        """Ensures routine runs and queue depths are exposed."""
+        with open(join(RIGHTS_FIXTURE_DIR, 'rights_service_response.json')) as json_file:
+            mock_rights.return_value.status_code = 200
+            mock_rights.return_value.content = json_file.read()
+        RightsAssigner().run()
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        lines = response.content.decode().splitlines()
+        self.assertIn('zorya_bags{status="1",name="Discovered"} 2', lines)
+        self.assertIn('zorya_bags{status="2",name="Assigned rights"} 1', lines)
+        self.assertTrue(any(line.startswith('zorya_bags_processed_total{routine="RightsAssigner",outcome="success"}') for line in lines))
+        self.assertTrue(any(line.startswith('zorya_bag_process_seconds_count{routine="RightsAssigner"}') for line in lines))
+
+
+class TestBenchmark(TestCase):
+
+    def test_make_bag(self):
+        """Ensures synthetic bags conform to the BagIt profile."""
+        set_up_directories([settings.TMP_DIR])
+        bag = make_bag(join(settings.TMP_DIR, "bag"), 3, 1024, 0.5)
+        self.assertTrue(bag.is_valid())
+        self.assertEqual(profile_registry.validate(bag), [])
+        shutil.rmtree(settings.TMP_DIR)
+
+    def test_benchmark_command(self):
+        """Ensures every routine is benchmarked and results are saved."""
+        set_up_directories([settings.TMP_DIR])
+        output_path = join(settings.TMP_DIR, "results.json")
+        with patch("package_bag.management.commands.benchmark.throwaway_database", nullcontext):
+            call_command(
+                "benchmark", bags=2, files=2, file_size=1024, other_objects=5,
+                service_latency=0, output=output_path, stdout=io.StringIO())
+        with open(output_path) as f:
+            report = json.load(f)
+        self.assertEqual(list(report["results"]), [routine.__name__ for routine in ROUTINES])
+        for result in report["results"].values():
+            self.assertEqual(result["processed"], 2)
+        self.assertEqual(Bag.objects.count(), 0)
+        shutil.rmtree(settings.TMP_DIR)
+
+    def test_sandbox_requires_empty_database(self):
+        """Ensures routines are not run in a sandbox alongside existing bags."""
+        Bag.objects.create(original_bag_name="existing.tar.gz", process_status=Bag.SAVED)
+        with self.assertRaises(Exception):
+            with sandbox():
+                pass
+
+
+class TestSimulation(TestCase):
+
+    def test_fake_service(self):
+        """Ensures fake services answer requests and fail the configured proportion of them."""
+        with FakeService({"rights_statements": []}, latency=0) as service:
+            response = requests.post(service.url, json={})
+            self.assertEqual(response.json(), {"rights_statements": []})
+            service.error_rate = 1
+            self.assertEqual(requests.post(service.url, json={}).status_code, 503)
+        self.assertEqual((service.requests, service.errors), (2, 1))
+
+    def test_simulate_pipeline(self):
+        """Ensures bags are driven from S3 to delivery."""
+        output = io.StringIO()
+        with patch("package_bag.management.commands.simulate_pipeline.throwaway_database", nullcontext):
+            call_command(
+                "simulate_pipeline", bags=2, files=2, file_size=1024, rights_latency=0,
+                delivery_latency=0, timeout=60, stdout=output)
+        results = json.loads(output.getvalue())["results"]
+        self.assertEqual(results["delivered"], 2)
+        self.assertEqual(results["requests"]["delivery"]["total"], 2)
+        self.assertIsNotNone(results["latency"]["p50"])
+        self.assertEqual(Bag.objects.count(), 0)
+
+
+class TestQueueDepth(TestCase):
+    fixtures = ["get_rights.json"]
+
+    def setUp(self):
+        cache.clear()
+
+    def test_queue_depth_view(self):
+        """Ensures bags are counted per process status and origin, and counts are cached."""
+        Bag.objects.filter(pk=1).update(process_status=Bag.ASSIGNED_RIGHTS, origin="av_digitization")
+        response = self.client.get(reverse("queue-depth"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["total"], 3)
+        self.assertEqual(response.data["origins"], {"digitization": 2, "av_digitization": 1})
+        statuses = {status["process_status"]: status for status in response.data["process_statuses"]}
+        self.assertEqual(statuses[Bag.DISCOVERED]["count"], 2)
+        self.assertEqual(statuses[Bag.ASSIGNED_RIGHTS]["origins"], {"av_digitization": 1})
+        self.assertEqual(statuses[Bag.DELIVERED]["count"], 0)
+        Bag.objects.filter(pk=2).delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(queue_depth()["total"], 3)
+
+
+class TestBagViewSet(TestCase):
+    fixtures = ["get_rights.json"]
+
+    def test_list(self):
+        """Ensures bags are listed by cursor in a compact representation."""
+        response = self.client.get(reverse("bag-list"), {"page_size": 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("count", response.data)
+        self.assertEqual([bag["id"] for bag in response.data["results"]], [3, 2])
+        self.assertNotIn("rights_statements", response.data["results"][0])
+        next_page = self.client.get(response.data["next"])
+        self.assertEqual([bag["id"] for bag in next_page.data["results"]], [1])
+        detail = self.client.get(reverse("bag-detail", args=[1]))
+        self.assertIn("rights_statements", detail.data)
+
+    def test_list_filters(self):
+        """Ensures bags can be filtered by process status, origin and date."""
+        Bag.objects.filter(pk=1).update(process_status=Bag.ASSIGNED_RIGHTS, origin="av_digitization")
+        for params, expected in [
+                ({"process_status": "2"}, [1]),
+                ({"process_status": "1,2"}, [3, 2, 1]),
+                ({"origin": "av_digitization"}, [1]),
+                ({"last_modified_after": "2000-01-01"}, [3, 2, 1]),
+                ({"last_modified_before": "2000-01-01T00:00:00Z"}, [])]:
+            response = self.client.get(reverse("bag-list"), params)
+            self.assertEqual([bag["id"] for bag in response.data["results"]], expected, params)
+        for params in [{"process_status": "discovered"}, {"created_after": "yesterday"}]:
+            self.assertEqual(self.client.get(reverse("bag-list"), params).status_code, 400)
+
+    def test_date_filters(self):
+        """Ensures date filters use the time a bag was created and the time it was last saved."""
+        Bag.objects.get(pk=1).save()
+        for params, expected in [
+                ({"created_after": "2022-01-01"}, []),
+                ({"created_before": "2022-01-01"}, [3, 2, 1]),
+                ({"last_modified_after": "2022-01-01"}, [1]),
+                ({"last_modified_before": "2022-01-01"}, [3, 2])]:
+            response = self.client.get(reverse("bag-list"), params)
+            self.assertEqual([bag["id"] for bag in response.data["results"]], expected, params)
+        listed = self.client.get(reverse("bag-list"), {"last_modified_after": "2022-01-01"}).data["results"][0]
+        self.assertLess(listed["created"], "2022-01-01")
+        self.assertGreaterEqual(listed["last_modified"], "2022-01-01")
+
+    def test_conditional_get(self):
+        """Ensures unchanged lists are not sent again."""
+        response = self.client.get(reverse("bag-list"))
+        self.assertTrue(response.has_header("ETag"))
+        self.assertEqual(self.client.get(reverse("bag-list"), HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+
+
 class TestViews(TestCase):
     def setUp(self):
         self.factory = APIRequestFactory()
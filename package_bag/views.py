@@ -1,18 +1,86 @@
 from asterism.views import RoutineView
+from django.http import HttpResponse
+from django.utils.dateparse import parse_date, parse_datetime
+from django.views import View
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet
 
+from .metrics import queue_depth, registry
 from .models import Bag
+from .pagination import BagCursorPagination
 from .routines import (BagDiscoverer, PackageArchiver, PackageDeliverer,
                        PackageMaker, RightsAssigner, S3ObjectDownloader,
                        S3ObjectFinder)
-from .serializers import BagSerializer
+from .serializers import BagListSerializer, BagSerializer
 
 
 class BagViewSet(ModelViewSet):
-    """Viewset for Bag objects."""
+    """Viewset for Bag objects.
+
+    Lists are paginated by cursor, use a compact representation without
+    rights statements, and can be filtered with the following query parameters:
+        process_status: one or more comma-separated process statuses.
+        origin: a bag origin.
+        created_after, created_before, last_modified_after,
+            last_modified_before: ISO 8601 dates or datetimes.
+
+    Bags in the Failed status can be returned to the pipeline by POSTing to
+    their `requeue` route.
+    """
     model = Bag
     queryset = Bag.objects.all()
     serializer_class = BagSerializer
+    pagination_class = BagCursorPagination
+    list_fields = ("bag_identifier", "original_bag_name", "origin", "process_status", "duplicate_of", "attempts", "last_error", "next_attempt",
+                   "created", "last_modified")
+    date_filters = {
+        "created_after": "created__gte",
+        "created_before": "created__lt",
+        "last_modified_after": "last_modified__gte",
+        "last_modified_before": "last_modified__lt",
+    }
+
+    def get_serializer_class(self):
+        if self.action == "list":
+            return BagListSerializer
+        return BagSerializer
+
+    def get_queryset(self):
+        queryset = super(BagViewSet, self).get_queryset()
+        if self.action != "list":
+            return queryset
+        params = self.request.query_params
+        filters = {}
+        if params.get("process_status"):
+            try:
+                filters["process_status__in"] = [int(status) for status in params["process_status"].split(",")]
+            except ValueError:
+                raise ValidationError({"process_status": "Process statuses must be integers."})
+        if params.get("origin"):
+            filters["origin"] = params["origin"]
+        for param, lookup in self.date_filters.items():
+            if params.get(param):
+                value = parse_datetime(params[param]) or parse_date(params[param])
+                if value is None:
+                    raise ValidationError({param: "Enter a valid ISO 8601 date or datetime."})
+                filters[lookup] = value
+        return queryset.filter(**filters).only(*self.list_fields)
+
+    @action(detail=True, methods=["post"])
+    def requeue(self, request, pk=None):
+        """Returns a failed bag to the status it failed from, to be retried straight away"""
+        bag = self.get_object()
+        if bag.process_status != Bag.FAILED:
+            raise ValidationError({"process_status": "Only failed bags can be requeued."})
+        bag.process_status = bag.retry_status
+        bag.retry_status = None
+        bag.attempts = 0
+        bag.next_attempt = None
+        bag.save()
+        return Response(BagListSerializer(bag).data)
 
 
 class S3ObjectDownloaderView(RoutineView):
@@ -48,3 +116,17 @@ class PackageArchiverView(RoutineView):
 class PackageDelivererView(RoutineView):
     """Triggers the PackageDeliverer routine."""
     routine = PackageDeliverer
+
+
+class MetricsView(View):
+    """Returns metrics for this process in the Prometheus text exposition format."""
+
+    def get(self, request):
+        return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+class QueueDepthView(APIView):
+    """Returns the number of bags in each process status and from each origin."""
+
+    def get(self, request):
+        return Response(queue_depth())
@@ -47,6 +47,7 @@ MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'django.middleware.http.ConditionalGetMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
@@ -134,12 +135,56 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 25,
 }
 
+# BagIt profiles, relative to the package_bag directory, keyed by bag Origin
+BAGIT_PROFILES = {
+    'default': 'zorya_bagit_profile.json',
+    'legacy_digital': 'zorya_bagit_profile.json',
+    'digitization': 'zorya_bagit_profile.json',
+    'av_digitization': 'zorya_bagit_profile.json',
+}
+
 SRC_DIR = CF.SRC_DIR
 TMP_DIR = CF.TMP_DIR
 DEST_DIR = CF.DEST_DIR
 
 DELIVERY_URL = CF.DELIVERY_URL
+# Deployed configuration quotes the URL, so an unset variable gives an empty string
+DELIVERY_UPLOAD_URL = CF.DELIVERY_UPLOAD_URL if CF.DELIVERY_UPLOAD_URL not in ("", "None") else None
+DELIVERY_UPLOAD_CHUNK_SIZE = CF.DELIVERY_UPLOAD_CHUNK_SIZE
 RIGHTS_URL = CF.RIGHTS_URL
+RIGHTS_BATCH_SIZE = CF.RIGHTS_BATCH_SIZE
+RIGHTS_CACHE_TIMEOUT = CF.RIGHTS_CACHE_TIMEOUT
+DELIVERY_BATCH_SIZE = CF.DELIVERY_BATCH_SIZE
+REQUESTS_IN_FLIGHT = CF.REQUESTS_IN_FLIGHT
+
+ROUTINE_CONCURRENCY = CF.ROUTINE_CONCURRENCY
+MAX_ATTEMPTS = CF.MAX_ATTEMPTS
+RETRY_BACKOFF = CF.RETRY_BACKOFF
+RETRY_BACKOFF_MAX = CF.RETRY_BACKOFF_MAX
+LEASE_DURATION = CF.LEASE_DURATION
+
+S3_DOWNLOAD_PART_SIZE = CF.S3_DOWNLOAD_PART_SIZE
+S3_DOWNLOAD_THREADS = CF.S3_DOWNLOAD_THREADS
+S3_STREAM_EXTRACT = CF.S3_STREAM_EXTRACT
+
+BAG_VALIDATION_WORKERS = CF.BAG_VALIDATION_WORKERS
+
+JSON_PRETTY_PRINT = CF.JSON_PRETTY_PRINT
+
+PACKAGE_FORMAT = CF.PACKAGE_FORMAT
+PACKAGE_COMPRESSION = CF.PACKAGE_COMPRESSION
+COMPRESSION_WORKERS = CF.COMPRESSION_WORKERS
+
+# HTTP clients for the rights and delivery services
+HTTP_TIMEOUT = (5, 60)  # connect and read timeouts, in seconds
+HTTP_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5
+HTTP_POOL_SIZE = 10
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+
+# Number of seconds counts of bags in each process status are cached for
+QUEUE_DEPTH_CACHE_TIMEOUT = 5
 
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
@@ -18,10 +18,11 @@ from django.contrib import admin
 from django.urls import include, path, re_path
 from rest_framework import routers
 
-from package_bag.views import (BagDiscovererView, BagViewSet,
+from package_bag.views import (BagDiscovererView, BagViewSet, MetricsView,
                                PackageArchiverView, PackageDelivererView,
-                               PackageMakerView, RightsAssignerView,
-                               S3ObjectDownloaderView, S3ObjectFinderView)
+                               PackageMakerView, QueueDepthView,
+                               RightsAssignerView, S3ObjectDownloaderView,
+                               S3ObjectFinderView)
 
 router = routers.DefaultRouter()
 router.register(r'bags', BagViewSet, 'bag')
@@ -34,6 +35,8 @@ urlpatterns = [
     path('make-package/', PackageMakerView.as_view(), name="packagemaker"),
     path('archive-package/', PackageArchiverView.as_view(), name="packagearchiver"),
     path('deliver-package/', PackageDelivererView.as_view(), name="packagedeliverer"),
+    path('metrics/', MetricsView.as_view(), name="metrics"),
+    path('queue-depth/', QueueDepthView.as_view(), name="queue-depth"),
     path('admin/', admin.site.urls),
     path('', include(router.urls)),
     re_path('status/', PingView.as_view(), name="ping"),